@@ -25,7 +25,11 @@ setup(
     url = "https://github.com/imandr/tinyrsa",
     packages=['tinyrsa', "tinyrsa.ui"],
     long_description=read('README.rst'),
-    install_requires=["pycrypto"],
+    install_requires=["pycryptodome"],
+    extras_require={
+        "numpy": ["numpy"],           # faster prime candidate sieve
+        "gmpy2": ["gmpy2"],           # faster big integer arithmetic
+    },
     zip_safe = False,
     classifiers=[
     ],
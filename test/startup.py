@@ -0,0 +1,83 @@
+#
+# Startup time budget for the command line script.
+#
+# Runs each command with "python -X importtime -m tinyrsa.ui.rsa ..." in a fresh interpreter,
+# against a key pair generated in a temporary directory, and checks that no heavy module
+# unrelated to the command is imported, and that the cumulative import time of tinyrsa
+# modules (including everything they import) stays within the budget. Interpreter startup
+# is not counted.
+#
+# Usage: python startup.py [<budget, milliseconds>]
+#
+
+import sys, subprocess, os, tempfile, time
+
+Budget = float(sys.argv[1]) if len(sys.argv) > 1 else 100.0     # milliseconds
+
+Commands = [
+    #   name            command line arguments                                  allowed heavy modules
+    #                   (key generation uses uuid for key ids, and numpy and gmpy2, if installed;
+    #                   private key operations use gmpy2, if installed)
+    ("usage",           [],                                                     []),
+    ("generate",        ["generate", "-s", "1024", "-k", "key2"],               ["uuid", "numpy", "gmpy2"]),
+    ("public",          ["public", "-k", "key", "-o", "key.public"],            []),
+    ("sign",            ["sign", "-k", "key", "data", "data.sig"],              ["gmpy2"]),
+    ("verify",          ["verify", "-k", "key.public", "data", "data.sig"],     []),
+    ("keyring",         ["keyring", "list", "keyring"],                         []),
+    ("client",          ["--server", "sock", "sign", "-k", "key", "data", "-"], []),
+]
+
+Forbidden = ["Crypto", "gmpy2", "numpy", "multiprocessing", "tinyrsa.aes", "tinyrsa.envelope", "uuid"]
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+Env = dict(os.environ, PYTHONPATH=Root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+
+def tinyrsa(args, cwd, importtime=False, check=True):
+    options = ["-X", "importtime"] if importtime else []
+    return subprocess.run([sys.executable] + options + ["-m", "tinyrsa.ui.rsa"] + args,
+            capture_output=True, text=True, env=Env, cwd=cwd, check=check)
+
+def import_time(args, cwd):
+    # returns (cumulative import time of tinyrsa modules in milliseconds, set of imported modules)
+    p = tinyrsa(args, cwd, importtime=True, check=False)
+    if args and p.returncode != 0:
+        raise RuntimeError("%s failed: %s" % (" ".join(args), p.stderr[-1000:]))
+    loaded = set()
+    total = 0
+    for line in p.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        loaded.add(name.strip())
+        if name.startswith(" tinyrsa"):             # top level tinyrsa imports only
+            total += int(cumulative)
+    return total/1000.0, loaded
+
+def is_forbidden(name, allowed):
+    return any(name == m or name.startswith(m + ".") for m in Forbidden if m not in allowed)
+
+with tempfile.TemporaryDirectory() as tmp:
+    tinyrsa(["generate", "-s", "1024", "-k", "key"], tmp)
+    tinyrsa(["keyring", "import", "keyring", "key"], tmp)
+    with open(os.path.join(tmp, "data"), "wb") as f:
+        f.write(os.urandom(10000))
+    server = subprocess.Popen([sys.executable, "-m", "tinyrsa.ui.rsa", "serve", "-k", "key", "sock"],
+            env=Env, cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            if os.path.exists(os.path.join(tmp, "sock")):
+                break
+            time.sleep(0.1)
+        failed = False
+        for command, args, allowed in Commands:
+            t, loaded = import_time(args, tmp)
+            heavy = sorted(m for m in loaded if is_forbidden(m, allowed))
+            ok = t <= Budget and not heavy
+            failed = failed or not ok
+            print("%-10s %6.1f ms %s %s" % (command, t, "ok" if ok else "FAILED", " ".join(heavy)))
+    finally:
+        server.terminate()
+        server.wait()
+
+sys.exit(1 if failed else 0)
@@ -55,3 +55,36 @@ cat story
 
 
 
+
+echo
+echo "Alice encrypts and signs the story for Bob in one pass ..."
+tinyrsa seal -k bob.public -s alice story sealed sealed.signature
+ls -l story sealed sealed.signature
+
+echo
+echo "Bob decrypts the story and verifies Alice's signature in one pass ..."
+tinyrsa open -k bob -s alice.public sealed opened sealed.signature
+cmp story opened && echo "opened story is the same"
+
+echo
+echo "Alice encrypts the story for Bob in the older format version 1 ..."
+tinyrsa encrypt -f 1 -k bob.public story encrypted.v1
+tinyrsa decrypt -k bob encrypted.v1 decrypted.v1
+cmp story decrypted.v1 && echo "decrypted version 1 story is the same"
+
+echo
+echo "Bob decrypts only a part of the story ..."
+tinyrsa decrypt -k bob --range 100:200 encrypted part
+tail -c +101 story | head -c 200 | cmp - part && echo "decrypted part is the same"
+tinyrsa decrypt -k bob --range 100:200 encrypted.v1 part.v1
+tail -c +101 story | head -c 200 | cmp - part.v1 && echo "decrypted version 1 part is the same"
+
+echo
+echo "Alice keeps a growing log encrypted for Bob ..."
+cp story log
+rm -f log.encrypted log.encrypted.state
+tinyrsa encrypt -a -k bob.public log log.encrypted
+cat story >> log
+tinyrsa encrypt -a -v -k bob.public log log.encrypted
+tinyrsa decrypt -k bob log.encrypted log.decrypted
+cmp log log.decrypted && echo "decrypted log is the same"
@@ -1,5 +1,24 @@
-from .keys import Key, KeyPair
-from .rsalib import RSA
 from .version import version
 
-__version__ = version
\ No newline at end of file
+__version__ = version
+
+#
+# Submodules are imported on first access to the names they define,
+# so that importing tinyrsa does not import modules the caller does not use.
+#
+
+_lazy = {
+    "Key":      "keys",
+    "KeyPair":  "keys",
+    "RSA":      "rsalib",
+    "KeyPool":  "keypool"
+}
+
+def __getattr__(name):
+    if name in _lazy:
+        import importlib
+        return getattr(importlib.import_module("." + _lazy[name], __name__), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy))
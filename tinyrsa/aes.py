@@ -1,12 +1,26 @@
-import secrets, Crypto, hashlib, struct              # pycrypto is requred
+import secrets, Crypto, hashlib, struct, time, os    # pycryptodome is requred
 from Crypto.Cipher import AES as _AES
+from tinyrsa import stats
+
+# pycryptodome (Crypto 3.x) ciphers can write into a caller-supplied buffer
+OUTPUT_BUFFERS = getattr(Crypto, "version_info", (2,))[0] >= 3
+
+def read_full(f, view):
+    # fills the memoryview from the file, unless EOF is reached first. Returns number of bytes read
+    n = 0
+    while n < len(view):
+        nread = f.readinto(view[n:])
+        if not nread:
+            break
+        n += nread
+    return n
 
 class AES(object):
     
     HEAD_PAD = 64
     
     def __init__(self, key=None, iv=None):
-        import secrets, Crypto              # pycrypto is requred
+        import secrets, Crypto              # pycryptodome is requred
         if key is None:
             key = secrets.token_bytes(16)   # AES uses 16 bytes key
         elif isinstance(key, str):
@@ -23,11 +37,13 @@ class AES(object):
         self.Cipher = _AES.new(key, _AES.MODE_CBC, iv)
         self.IV = iv
         self.InBytes = self.OutBytes = 0
-        self.RemoveHead = True
+        self.Buffers = 0                # number of buffers allocated by the streaming engine
+        self.Elapsed = 0.0
+        self.RemoveHead = self.HEAD_PAD     # bytes of the random head still to be removed when decrypting
         self.Head = secrets.token_bytes(self.HEAD_PAD)
         
     def encrypt(self, data):
-        import secrets, Crypto              # pycrypto is requred
+        import secrets, Crypto              # pycryptodome is requred
         if isinstance(data, str):
             data = data.encode("utf-8")
         l = len(data)
@@ -39,6 +55,7 @@ class AES(object):
         self.Head = b''
         #print("encrypt: padded_data:", len(padded_data))
         encrypted = self.Cipher.encrypt(padded_data)
+        stats.count("aes.bytes_encrypted", len(padded_data))
         self.OutBytes += len(encrypted)
         return encrypted
         
@@ -46,9 +63,11 @@ class AES(object):
         if isinstance(encrypted, str):   encrypted = encrypted.encode("utf-8")
         self.InBytes += len(encrypted)
         data = self.Cipher.decrypt(encrypted)
+        stats.count("aes.bytes_decrypted", len(encrypted))
         if self.RemoveHead:
-            data = data[self.HEAD_PAD:]
-            self.RemoveHead = False
+            skip = min(self.RemoveHead, len(data))
+            data = data[skip:]
+            self.RemoveHead -= skip
         self.OutBytes += len(data)
         return data       
         
@@ -78,9 +97,117 @@ class AES(object):
                 eof = True
         #print("In/out bytes:", self.InBytes, self.OutBytes)
                 
+    #
+    # Streaming engine: reads with readinto() into preallocated buffers and lets the cipher 
+    # write into a preallocated output buffer, so no new objects are created per block.
+    # Produces the same output as encrypt_file_stream/decrypt_file_stream.
+    #
+    
+    STREAM_BLOCK_SIZE = 1024*1024
+    
+    def stream_buffers(self, block_size):
+        block_size = ((block_size or self.STREAM_BLOCK_SIZE)+15)//16*16
+        self.Buffers += 2
+        return memoryview(bytearray(block_size)), memoryview(bytearray(block_size))
+        
+    def encrypt_into(self, view, outview):
+        stats.count("aes.bytes_encrypted", len(view))
+        if OUTPUT_BUFFERS:
+            self.Cipher.encrypt(view, output=outview)
+            return outview
+        else:
+            return self.Cipher.encrypt(bytes(view))
+    
+    def decrypt_into(self, view, outview):
+        stats.count("aes.bytes_decrypted", len(view))
+        if OUTPUT_BUFFERS:
+            self.Cipher.decrypt(view, output=outview)
+            return outview
+        else:
+            return memoryview(self.Cipher.decrypt(bytes(view)))
+            
+    def encrypt_stream_into(self, inp, out, block_size=None):
+        t0 = time.perf_counter()
+        inbuf, outbuf = self.stream_buffers(block_size)
+        n = len(inbuf)
+        while n == len(inbuf):
+            n = read_full(inp, inbuf)
+            if n == 0:
+                break
+            if self.Head:
+                out.write(self.Cipher.encrypt(self.Head))
+                self.OutBytes += len(self.Head)
+                self.Head = b''
+            self.InBytes += n
+            padded_n = (n+15)//16*16
+            if padded_n > n:
+                inbuf[n:padded_n] = secrets.token_bytes(padded_n - n)
+            out.write(self.encrypt_into(inbuf[:padded_n], outbuf[:padded_n]))
+            self.OutBytes += padded_n
+        self.Elapsed += time.perf_counter() - t0
+        
+    def decrypt_stream_into(self, inp, out, length, block_size=None):
+        t0 = time.perf_counter()
+        inbuf, outbuf = self.stream_buffers(block_size)
+        while length > 0:
+            n = read_full(inp, inbuf)
+            if n == 0:
+                break
+            self.InBytes += n
+            decrypted = self.decrypt_into(inbuf[:n], outbuf[:n])
+            if self.RemoveHead:
+                skip = min(self.RemoveHead, len(decrypted))
+                decrypted = decrypted[skip:]
+                self.RemoveHead -= skip
+            l = min(len(decrypted), length)
+            out.write(decrypted[:l])
+            self.OutBytes += l
+            length -= l
+        self.Elapsed += time.perf_counter() - t0
+        
+    def read_header(self, f):
+        # reads the header at the current position and returns plaintext length and position of encrypted data
+        length = int.from_bytes(f.read(8), byteorder="big")
+        iv = f.read(16)
+        self.init(self.Key, iv)
+        return length, f.tell()
+        
+    def decrypt_range(self, f, data_start, length, offset, size):
+        #
+        # Decrypts <size> bytes of plaintext starting at <offset> without decrypting 
+        # anything before it. In CBC mode, a block is decrypted using the previous 
+        # ciphertext block (or the IV for the first block) as its IV.
+        #
+        if offset < 0 or size < 0:
+            raise ValueError("Negative offset or size: %d, %d" % (offset, size))
+        size = max(0, min(size, length - offset))
+        if size == 0:
+            return b''
+        first = (self.HEAD_PAD + offset)//16
+        last = (self.HEAD_PAD + offset + size - 1)//16
+        if first == 0:
+            iv = self.IV
+            f.seek(data_start)
+        else:
+            f.seek(data_start + (first-1)*16)
+            iv = f.read(16)
+        encrypted = f.read((last-first+1)*16)
+        data = _AES.new(self.Key, _AES.MODE_CBC, iv).decrypt(encrypted)
+        skip = self.HEAD_PAD + offset - first*16
+        return data[skip:skip+size]
+        
+    def stats(self):
+        return dict(
+            in_bytes = self.InBytes,
+            out_bytes = self.OutBytes,
+            buffers = self.Buffers,
+            seconds = self.Elapsed,
+            throughput = self.InBytes/self.Elapsed if self.Elapsed > 0 else None      # bytes/second
+        )
+                
     HEADER_LENGTH = 8+16
                 
-    def encrypt_file(self, inp, out):
+    def encrypt_file(self, inp, out, block_size=None):
         #
         # header:
         # original length, 128 bytes, big endian
@@ -89,8 +216,11 @@ class AES(object):
         #
         start = out.tell()
         out.seek(start+self.HEADER_LENGTH)
-        for block in self.encrypt_file_stream(inp):
-            out.write(block)
+        if hasattr(inp, "readinto"):
+            self.encrypt_stream_into(inp, out, block_size)
+        else:
+            for block in self.encrypt_file_stream(inp):
+                out.write(block)
         out.truncate()
         out.seek(start)
         out.write(self.InBytes.to_bytes(8, byteorder="big"))
@@ -98,15 +228,255 @@ class AES(object):
         out.seek(0, 2)
         return self.InBytes
 
-    def decrypt_file(self, inp, out):
+    APPEND_CHECK_SIZE = 4096     # the end of the previously encrypted input is compared with the input file
+
+    def append_file(self, inp, out, block_size=None):
+        #
+        # Continues the encryption of a file which was encrypted by encrypt_file with the
+        # same key and has grown since. inp is the whole input file, out is the encrypted 
+        # file opened for reading and writing, positioned at the header. Only the last 
+        # block and the new data are encrypted, with the previous ciphertext block as the IV,
+        # and the length in the header is updated in place. Returns the new length.
+        #
+        start = out.tell()
+        length = int.from_bytes(out.read(8), byteorder="big")
+        if length == 0:
+            out.seek(start)
+            return self.encrypt_file(inp, out, block_size)
+        data_start = start + self.HEADER_LENGTH + self.HEAD_PAD
+        last = (length-1)//16*16                # offset of the last, possibly partial, block
+        check = max(0, last - self.APPEND_CHECK_SIZE)
+        out.seek(data_start + check - 16)
+        encrypted = out.read(last + 32 - check)
+        inp.seek(check)
+        data = inp.read(length - check)
+        if len(encrypted) != last + 32 - check or \
+                _AES.new(self.Key, _AES.MODE_CBC, encrypted[:16]).decrypt(encrypted[16:])[:len(data)] != data:
+            raise ValueError("The input file was modified, not only appended to")
+        iv = encrypted[-32:-16]
+        if length % 16 == 0:
+            last, iv = length, encrypted[-16:]  # continue after the last full block
+        out.seek(data_start + last)
+        out.truncate()
+        inp.seek(last)
+        self.init(self.Key, iv)
+        self.Head = b''
+        self.encrypt_stream_into(inp, out, block_size)
+        length = last + self.InBytes
+        out.seek(start)
+        out.write(length.to_bytes(8, byteorder="big"))
+        out.seek(0, 2)
+        return length
+
+    #
+    # Parallel decryption: in CBC mode, each plaintext block depends only on two ciphertext 
+    # blocks, so the ciphertext is split into segments, which are decrypted concurrently,
+    # each with the last ciphertext block of the previous segment as its IV.
+    #
+    
+    SEGMENT_SIZE = 4*1024*1024
+    
+    def decrypt_segment(self, fd, segment):
+        offset, size, iv = segment
+        stats.count("aes.bytes_decrypted", size)
+        if iv is None:
+            iv = os.pread(fd, 16, offset-16)
+        return _AES.new(self.Key, _AES.MODE_CBC, iv).decrypt(os.pread(fd, size, offset))
+    
+    def decrypt_segments(self, inp, out, length, workers, segment_size=None):
+        from tinyrsa.rsalib import parallel_map
+        from concurrent.futures import ThreadPoolExecutor
+        t0 = time.perf_counter()
+        segment_size = ((segment_size or self.SEGMENT_SIZE)+15)//16*16
+        fd = inp.fileno()
+        data_start = inp.tell()
+        encrypted_size = self.HEAD_PAD + (length+15)//16*16 if length > 0 else 0
+        segments = [(data_start + offset, min(segment_size, encrypted_size - offset), None if offset else self.IV)
+                    for offset in range(0, encrypted_size, segment_size)]
+        with ThreadPoolExecutor(workers) as executor:
+            results = parallel_map(self.decrypt_segment, fd, segments, executor=executor, batch=1, window=2*workers)
+            for (offset, _, _), data in zip(segments, results):
+                self.InBytes += len(data)
+                skip = max(0, self.HEAD_PAD - (offset - data_start))    # the head may span several segments
+                data = memoryview(data)[skip:skip+length]
+                out.write(data)
+                length -= len(data)
+                self.OutBytes += len(data)
+        inp.seek(data_start + encrypted_size)
+        self.Elapsed += time.perf_counter() - t0
+                
+    def decrypt_file(self, inp, out, block_size=None, workers=None):
         length = int.from_bytes(inp.read(8), byteorder="big")
         #print("decrypt:length:", length)
         iv = inp.read(16)
         self.init(self.Key, iv)
-        for block in self.decrypt_file_stream(inp, length):
-            out.write(block)
+        if workers and workers > 1 and hasattr(inp, "fileno") and hasattr(os, "pread") and inp.seekable():
+            self.decrypt_segments(inp, out, length, workers, block_size)
+        elif hasattr(inp, "readinto"):
+            self.decrypt_stream_into(inp, out, length, block_size)
+        else:
+            for block in self.decrypt_file_stream(inp, length):
+                out.write(block)
         return self.OutBytes
         
+
+class ChunkedAES(object):
+    #
+    # Chunked container (file format version 2). The plaintext is split into chunks of
+    # equal size, only the last chunk can be shorter (or empty). Each chunk is encrypted 
+    # independently with AES-GCM, so chunks can be encrypted and decrypted in parallel
+    # and in any order.
+    #
+    # header:
+    # chunk size, 4 bytes, big endian
+    # nonce prefix, 8 bytes
+    # (chunks)
+    #
+    # chunk i:
+    # ciphertext, chunk size bytes or less for the last chunk
+    # GCM tag, 16 bytes
+    #
+    # The nonce of chunk i is nonce prefix + i as 4 bytes, big endian. The header and
+    # a flag marking the last chunk are authenticated as associated data, so
+    # reordered, truncated or extended files are detected.
+    #
+    
+    CHUNK_SIZE = 1024*1024
+    MAX_CHUNK_SIZE = 256*1024*1024      # a chunk is held in memory when encrypted or decrypted
+    TAG_SIZE = 16
+    HEADER_LENGTH = 4+8
+    
+    def __init__(self, key=None, chunk_size=None, nonce_prefix=None):
+        if key is None:
+            key = secrets.token_bytes(16)
+        assert isinstance(key, bytes) and len(key) == 16
+        self.Key = key
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+        if not 0 < chunk_size <= self.MAX_CHUNK_SIZE:
+            raise ValueError("Invalid chunk size: %d, must be between 1 and %d" % (chunk_size, self.MAX_CHUNK_SIZE))
+        self.ChunkSize = chunk_size
+        self.NoncePrefix = nonce_prefix or secrets.token_bytes(8)
+        self.Header = struct.pack(">I", self.ChunkSize) + self.NoncePrefix
+        self.InBytes = self.OutBytes = 0
+        self.Elapsed = 0.0
+        
+    @staticmethod
+    def from_header(key, header):
+        chunk_size, nonce_prefix = struct.unpack(">I8s", header)
+        return ChunkedAES(key, chunk_size, nonce_prefix)
+        
+    def record_size(self):
+        return self.ChunkSize + self.TAG_SIZE
+        
+    def cipher(self, index, final):
+        assert index < 1 << 32
+        cipher = _AES.new(self.Key, _AES.MODE_GCM, nonce=self.NoncePrefix + struct.pack(">I", index))
+        cipher.update(self.Header + (b'\x01' if final else b'\x00'))
+        return cipher
+        
+    def encrypt_chunk(self, index, data, final):
+        stats.count("aes.bytes_encrypted", len(data))
+        encrypted, tag = self.cipher(index, final).encrypt_and_digest(data)
+        return encrypted + tag
+        
+    def decrypt_chunk(self, index, record, final):
+        stats.count("aes.bytes_decrypted", len(record) - self.TAG_SIZE)
+        encrypted, tag = record[:-self.TAG_SIZE], record[-self.TAG_SIZE:]
+        try:
+            return self.cipher(index, final).decrypt_and_verify(encrypted, tag)
+        except ValueError:
+            raise ValueError("chunk %d: authentication failed" % (index,))
+            
+    def read_chunks(self, f, size):
+        # generates (index, chunk, final) tuples. Reads one chunk ahead to find the last one.
+        # Always generates at least one, possibly empty, chunk.
+        index = 0
+        chunk = f.read(size)
+        while True:
+            while 0 < len(chunk) < size:
+                more = f.read(size - len(chunk))
+                if not more:    break
+                chunk += more
+            next_chunk = f.read(size) if len(chunk) == size else b''
+            final = not next_chunk
+            yield index, chunk, final
+            if final:
+                break
+            chunk = next_chunk
+            index += 1
+            
+    @staticmethod
+    def process_chunk(func, item):
+        index, chunk, final = item
+        return func(index, chunk, final)
+            
+    def map_chunks(self, func, items, workers):
+        from tinyrsa.rsalib import parallel_map
+        from concurrent.futures import ThreadPoolExecutor
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            yield from parallel_map(self.process_chunk, func, items)
+            return
+        with ThreadPoolExecutor(workers) as executor:
+            yield from parallel_map(self.process_chunk, func, items, executor=executor, batch=1, window=2*workers)
+        
+    def encrypt_file(self, inp, out, workers=None):
+        t0 = time.perf_counter()
+        out.write(self.Header)
+        self.OutBytes += len(self.Header)
+        for record in self.map_chunks(self.encrypt_chunk, self.read_chunks(inp, self.ChunkSize), workers):
+            out.write(record)
+            self.InBytes += len(record) - self.TAG_SIZE
+            self.OutBytes += len(record)
+        self.Elapsed += time.perf_counter() - t0
+        return self.InBytes
+        
+    def decrypt_file(self, inp, out, workers=None):
+        # the header is expected to be read already
+        t0 = time.perf_counter()
+        for data in self.map_chunks(self.decrypt_chunk, self.read_chunks(inp, self.record_size()), workers):
+            out.write(data)
+            self.InBytes += len(data) + self.TAG_SIZE
+            self.OutBytes += len(data)
+        self.Elapsed += time.perf_counter() - t0
+        return self.OutBytes
+        
+    def chunk_count(self, payload_size):
+        # number of chunks in the payload of given size, which follows the header
+        return max(1, (payload_size + self.record_size() - 1)//self.record_size())
+        
+    def plaintext_size(self, payload_size):
+        return payload_size - self.chunk_count(payload_size)*self.TAG_SIZE
+        
+    def decrypt_range(self, f, data_start, payload_size, offset, size, workers=None):
+        #
+        # Decrypts <size> bytes of plaintext starting at <offset>. Only the chunks
+        # overlapping with the range are read and decrypted.
+        #
+        if offset < 0 or size < 0:
+            raise ValueError("Negative offset or size: %d, %d" % (offset, size))
+        size = max(0, min(size, self.plaintext_size(payload_size) - offset))
+        if size == 0:
+            return b''
+        nchunks = self.chunk_count(payload_size)
+        first = offset//self.ChunkSize
+        last = (offset + size - 1)//self.ChunkSize
+        f.seek(data_start + first*self.record_size())
+        def records():
+            for i in range(first, last+1):
+                yield i, f.read(self.record_size()), i == nchunks-1
+        data = b''.join(self.map_chunks(self.decrypt_chunk, records(), workers))
+        skip = offset - first*self.ChunkSize
+        return data[skip:skip+size]
+        
+    def stats(self):
+        return dict(
+            in_bytes = self.InBytes,
+            out_bytes = self.OutBytes,
+            seconds = self.Elapsed,
+            throughput = self.InBytes/self.Elapsed if self.Elapsed > 0 else None      # bytes/second
+        )
                 
 if __name__ == "__main__":
     import sys
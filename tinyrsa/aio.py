@@ -0,0 +1,137 @@
+#
+# Asyncio interface. Data sources are async byte streams: objects with a coroutine
+# read(n) method, like asyncio.StreamReader or aiohttp's StreamReader, or async
+# iterators of bytes. Hashing, RSA and AES work runs in an executor, the default
+# executor of the event loop unless another one is given, so the event loop is not blocked.
+#
+
+from tinyrsa.keys import Key, KeyPair
+from tinyrsa.rsalib import RSA
+from tinyrsa.aes import AES, ChunkedAES
+from tinyrsa import envelope
+
+import asyncio, struct
+
+READ_SIZE = 256*1024
+
+async def run(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+class AsyncReader(object):
+
+    def __init__(self, stream):
+        self.Stream = stream
+        self.Iterator = None if hasattr(stream, "read") else stream.__aiter__()
+        self.Buffer = b''
+        self.EOF = False
+
+    async def read_some(self, n):
+        if self.Iterator is None:
+            return await self.Stream.read(n)
+        try:
+            return await self.Iterator.__anext__()
+        except StopAsyncIteration:
+            return b''
+
+    async def read(self, n=READ_SIZE):
+        # returns exactly n bytes, or fewer at the end of the stream
+        while len(self.Buffer) < n and not self.EOF:
+            data = await self.read_some(n - len(self.Buffer))
+            if data:
+                self.Buffer += data
+            else:
+                self.EOF = True
+        data, self.Buffer = self.Buffer[:n], self.Buffer[n:]
+        return data
+
+    async def chunks(self, size):
+        # generates (index, chunk, final) tuples, see ChunkedAES.read_chunks
+        index = 0
+        chunk = await self.read(size)
+        while True:
+            next_chunk = await self.read(size) if len(chunk) == size else b''
+            final = not next_chunk
+            yield index, chunk, final
+            if final:
+                break
+            chunk = next_chunk
+            index += 1
+
+def read_file(path):
+    with open(path, "r") as f:
+        return f.read()
+
+async def load_key(path, executor=None):
+    # loads a public key or a key pair
+    return Key.from_json(await run(executor, read_file, path))
+
+async def load_keypair(path, executor=None):
+    return KeyPair.from_json(await run(executor, read_file, path))
+
+async def hash_data(h, stream, executor=None):
+    reader = AsyncReader(stream)
+    data = await reader.read()
+    while data:
+        await run(executor, h.update, data)
+        data = await reader.read()
+
+async def sign(rsa, stream, hash_method="sha3_256", executor=None):
+    h, salt = rsa.signature_hash(hash_method)
+    await hash_data(h, stream, executor)
+    return await run(executor, rsa.signature_from_hash, h, salt, hash_method)
+
+async def verify_signature(rsa, stream, signature, executor=None):
+    h, expected = await run(executor, rsa.verification_hash, signature)
+    await hash_data(h, stream, executor)
+    return h.digest() == expected
+
+async def encrypt(key, stream, executor=None, chunk_size=None):
+    # generates the encrypted file in pieces, format version 2, or 3 for a list of recipient keys
+    aes = ChunkedAES(chunk_size=chunk_size)
+    keys = list(key) if isinstance(key, (list, tuple)) else [key]
+    if len(keys) > 1:
+        slots = [(k.ID, await run(executor, RSA(k).encrypt, aes.Key)) for k in keys]
+        yield envelope.recipients_header(slots) + aes.Header
+    else:
+        enc_key = await run(executor, RSA(keys[0]).encrypt, aes.Key)
+        yield envelope.key_header(enc_key) + aes.Header
+    async for index, chunk, final in AsyncReader(stream).chunks(aes.ChunkSize):
+        yield await run(executor, aes.encrypt_chunk, index, chunk, final)
+
+async def decrypt(keypair, stream, executor=None):
+    # generates decrypted data from an encrypted file of either format version
+    reader = AsyncReader(stream)
+    l = (await reader.read(1))[0]
+    version = 1
+    if l == 0:
+        version = (await reader.read(1))[0]
+        if version not in (2, 3, 4):
+            raise ValueError("Unsupported format version: %s" % (version,))
+        l = struct.unpack(">H", await reader.read(2))[0]
+    if version == 3:
+        enc_key = None
+        for _ in range(l):
+            id = (await reader.read((await reader.read(1))[0])).decode("utf-8")
+            data = await reader.read(struct.unpack(">H", await reader.read(2))[0])
+            if id == keypair.ID:
+                enc_key = data
+        if enc_key is None:
+            raise ValueError("The file is not encrypted for key %s" % (keypair.ID,))
+    else:
+        enc_key = await reader.read(l)
+    enc_key = await run(executor, RSA(keypair).decrypt, enc_key)
+    if version in envelope.CBC_VERSIONS:
+        aes = AES(enc_key)
+        length = int.from_bytes(await reader.read(8), byteorder="big")
+        aes.init(enc_key, await reader.read(16))
+        while length > 0:
+            data = await reader.read(AES.STREAM_BLOCK_SIZE)
+            if not data:
+                break
+            data = (await run(executor, aes.decrypt, data))[:length]
+            length -= len(data)
+            yield data
+    else:
+        aes = ChunkedAES.from_header(enc_key, await reader.read(ChunkedAES.HEADER_LENGTH))
+        async for index, record, final in reader.chunks(aes.record_size()):
+            yield await run(executor, aes.decrypt_chunk, index, record, final)
@@ -0,0 +1,161 @@
+#
+# Benchmark suite. Each benchmark is timed several times and summarized as
+# percentiles of the time per operation, in seconds. Results are JSON-serializable
+# and can be compared against a saved baseline.
+#
+
+from tinyrsa.keys import KeyPair
+from tinyrsa.rsalib import RSA
+from tinyrsa.rnd import read_random_bytes, read_random_odd_int
+from tinyrsa.version import version
+from tinyrsa import bigint, primes
+
+import time, io, sys, platform, json
+
+def percentile(values, p):
+    values = sorted(values)
+    i = (len(values)-1)*p/100.0
+    lo = int(i)
+    hi = min(lo+1, len(values)-1)
+    return values[lo] + (values[hi]-values[lo])*(i-lo)
+
+def summary(times, nbytes=None):
+    s = dict(
+        n = len(times),
+        min = min(times),
+        mean = sum(times)/len(times),
+        p50 = percentile(times, 50),
+        p90 = percentile(times, 90),
+        p99 = percentile(times, 99),
+        max = max(times)
+    )
+    if nbytes:
+        s["mb_per_second"] = nbytes/s["p50"]/1024/1024
+    return s
+
+def timeit(func, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return times
+
+class Benchmark(object):
+
+    BENCHMARKS = ["generate", "is_prime", "get_prime", "rsa", "aes"]       # run by default, in this order
+
+    def __init__(self, quick=False, repeats=None, key_size=2048, log=None):
+        self.Quick = quick
+        self.Repeats = repeats
+        self.KeySize = key_size
+        self.Log = log
+        self.Results = {}
+
+    def repeats(self, default):
+        n = self.Repeats or default
+        return max(1, n//5) if self.Quick else n
+
+    def record(self, name, times, nbytes=None):
+        self.Results[name] = summary(times, nbytes)
+        if self.Log is not None:
+            print("%-32s p50: %.6f s" % (name, self.Results[name]["p50"]), file=self.Log)
+
+    def bench_generate(self):
+        sizes = [512, 1024] if self.Quick else [512, 1024, 2048]
+        for size in sizes:
+            self.record("generate.%d" % (size,), timeit(lambda: KeyPair.generate(size), self.repeats(10)))
+
+    def bench_is_prime(self):
+        # all primality test engines, on the same candidates
+        from tinyrsa import primes
+        # build the tables the engines use, and select the big integer backend, before timing
+        primes.sieve_primes()
+        primes.primorials()
+        for test in primes.PrimalityTests:
+            primes.is_prime(read_random_odd_int(1024), test)
+        for nbits in (1024, 2048):
+            candidates = [read_random_odd_int(nbits) for _ in range(self.repeats(1000))]
+            for test in sorted(primes.PrimalityTests):
+                times = []
+                for x in candidates:
+                    t0 = time.perf_counter()
+                    primes.is_prime(x, test)
+                    times.append(time.perf_counter() - t0)
+                self.record("is_prime.%s.%d" % (test, nbits), times)
+                
+    def bench_get_prime(self):
+        from tinyrsa import primes
+        saved = primes.PrimalityTest
+        try:
+            for test in sorted(primes.PrimalityTests):
+                primes.set_primality_test(test)
+                for nbits in (512, 1024):
+                    self.record("get_prime.%s.%d" % (test, nbits), timeit(lambda: primes.get_prime(nbits), self.repeats(20)))
+        finally:
+            primes.set_primality_test(saved)
+
+    def bench_rsa(self):
+        key = KeyPair.generate(self.KeySize)
+        rsa = RSA(key)
+        rsa_public = RSA(key.public_key())
+        session_key = read_random_bytes(16)
+        encrypted = rsa.encrypt(session_key)
+        data = read_random_bytes(1024)
+        signature = rsa.sign(data)
+        n = self.repeats(200)
+        self.record("rsa.encrypt", timeit(lambda: rsa.encrypt(session_key), n))
+        self.record("rsa.decrypt", timeit(lambda: rsa.decrypt(encrypted), n))
+        self.record("rsa.sign", timeit(lambda: rsa.sign(data), n))
+        self.record("rsa.verify_signature", timeit(lambda: rsa_public.verify_signature(data, signature), n))
+
+    def bench_aes(self):
+        try:
+            from tinyrsa.aes import AES
+        except ImportError:
+            return          # pycryptodome is not installed
+        size = 4*1024*1024 if self.Quick else 32*1024*1024
+        data = read_random_bytes(size)
+        aes = AES()
+        encrypted = io.BytesIO()
+        aes.encrypt_file(io.BytesIO(data), encrypted)
+        encrypted = encrypted.getvalue()
+        n = self.repeats(10)
+        self.record("aes.encrypt_file", timeit(lambda: AES(aes.Key).encrypt_file(io.BytesIO(data), io.BytesIO()), n), size)
+        self.record("aes.decrypt_file", timeit(lambda: AES(aes.Key).decrypt_file(io.BytesIO(encrypted), io.BytesIO()), n), size)
+
+    def run(self, benchmarks=None):
+        benchmarks = benchmarks or self.BENCHMARKS
+        unknown = [name for name in benchmarks if name not in self.BENCHMARKS]
+        if unknown:
+            raise ValueError("Unknown benchmark: %s, available: %s" % (", ".join(unknown), ", ".join(self.BENCHMARKS)))
+        for name in benchmarks:
+            getattr(self, "bench_" + name)()
+        return self.report()
+
+    def report(self):
+        return dict(
+            version = version,
+            python = platform.python_version(),
+            platform = platform.platform(),
+            bigint_backend = bigint.backend(),
+            primality_test = primes.PrimalityTest,
+            key_size = self.KeySize,
+            quick = self.Quick,
+            results = self.Results
+        )
+
+def compare(report, baseline, tolerance=0.1, stat="p50"):
+    # returns list of (name, baseline value, current value) for benchmarks slower than baseline by more than tolerance
+    regressions = []
+    for name, result in report["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if base is not None and result[stat] > base[stat] * (1.0 + tolerance):
+            regressions.append((name, base[stat], result[stat]))
+    return regressions
+
+def run(quick=False, repeats=None, benchmarks=None, log=None):
+    return Benchmark(quick=quick, repeats=repeats, log=log).run(benchmarks)
+
+if __name__ == "__main__":
+    print(json.dumps(run(quick=True, log=sys.stderr), indent=2))
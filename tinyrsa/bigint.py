@@ -0,0 +1,90 @@
+#
+# Big integer arithmetic backend.
+#
+# Modular exponentiation, modular inverse, gcd and probabilistic primality testing are
+# routed through this module, so that they can be done by gmpy2 (GMP), when it is
+# installed, or by pure Python code otherwise.
+#
+# The backend is selected with the TINYRSA_BIGINT environment variable ("python", "gmpy2"
+# or "auto", the default), or by calling set_backend(). Results are always Python ints.
+# The backend is selected on the first call, so that importing this module does not
+# import gmpy2.
+#
+
+import os, math
+
+def _python_invert(a, m):
+    return pow(a, -1, m)
+
+def _python_is_probable_prime(n, rounds):
+    from tinyrsa.primes import miller_rabin
+    return miller_rabin(n, rounds)
+
+def _gmpy2_functions():
+    import gmpy2
+    from tinyrsa import stats
+    def is_probable_prime(n, rounds):
+        # gmpy2 does not report the number of rounds done. As with the Python code, most 
+        # composites fail the first round, and a prime passes all of them
+        result = bool(gmpy2.is_prime(n, rounds))
+        stats.count("primes.miller_rabin_rounds", rounds if result else 1)
+        return result
+    return dict(
+        powmod = lambda b, e, m: int(gmpy2.powmod(b, e, m)),
+        invert = lambda a, m: int(gmpy2.invert(a, m)),
+        gcd = lambda a, b: int(gmpy2.gcd(a, b)),
+        is_probable_prime = is_probable_prime
+    )
+
+def _python_functions():
+    return dict(
+        powmod = pow,
+        invert = _python_invert,
+        gcd = math.gcd,
+        is_probable_prime = _python_is_probable_prime
+    )
+
+Backends = {
+    "python":   _python_functions,
+    "gmpy2":    _gmpy2_functions
+}
+
+Name = None
+
+def set_backend(name="auto"):
+    # returns the name of the selected backend
+    global Name, powmod, invert, gcd, is_probable_prime
+    if name == "auto":
+        try:
+            functions = _gmpy2_functions()
+            name = "gmpy2"
+        except ImportError:
+            functions = _python_functions()
+            name = "python"
+    elif name in Backends:
+        functions = Backends[name]()
+    else:
+        raise ValueError("Unknown big integer backend: %s" % (name,))
+    powmod = functions["powmod"]
+    invert = functions["invert"]
+    gcd = functions["gcd"]
+    is_probable_prime = functions["is_probable_prime"]
+    Name = name
+    return name
+
+def backend():
+    if Name is None:
+        set_backend(os.environ.get("TINYRSA_BIGINT", "auto"))
+    return Name
+
+def _select_on_call(name):
+    # placeholder for a backend function: selects the backend and calls its function
+    def function(*params):
+        backend()
+        return globals()[name](*params)
+    return function
+
+powmod = _select_on_call("powmod")
+invert = _select_on_call("invert")
+gcd = _select_on_call("gcd")
+is_probable_prime = _select_on_call("is_probable_prime")
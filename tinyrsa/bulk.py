@@ -0,0 +1,166 @@
+#
+# Encryption and decryption of directory trees.
+#
+# Files are processed in parallel by a pool of worker processes. The relative layout of
+# the source directory is preserved. The key is parsed and the session key is encrypted
+# with RSA once per run: all files encrypted in one run share the session key, and each
+# file gets its own random nonce prefix (see ChunkedAES). Encrypted files are regular
+# version 2 files (version 3 for several recipients), and each one can still be decrypted
+# on its own with "tinyrsa decrypt". When decrypting, each worker process decrypts each
+# distinct session key with RSA only once.
+#
+# The destination directory holds a manifest with the size and modification time of
+# every processed source file, and the parameters of the run: the recipient key ids and
+# the format version when encrypting, the key pair id when decrypting. Files that have
+# not changed since the previous run are skipped, unless the parameters have changed.
+#
+
+from tinyrsa.envelope import key_header, recipients_header, read_encrypted_key, CBC_VERSIONS
+from tinyrsa.aes import AES, ChunkedAES
+from tinyrsa.rsalib import RSA, parallel_map
+from tinyrsa import stats
+
+import os, stat, json, time
+
+MANIFEST_NAME = ".tinyrsa-tree.json"
+PART_SUFFIX = ".tinyrsa-part"
+BATCH = 16                  # files per task sent to a worker process
+
+def walk(src):
+    # generates (relative path, size, mtime_ns) for regular files under src
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            path = os.path.join(dirpath, fn)
+            rel = os.path.relpath(path, src)
+            if rel == MANIFEST_NAME or fn.endswith(PART_SUFFIX):
+                continue
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                yield rel, st.st_size, st.st_mtime_ns
+
+MANIFEST_VERSION = 2
+
+def load_manifest(dst, params):
+    # relative path -> [size, mtime_ns] of the source file, empty if the manifest
+    # was written with other parameters
+    try:
+        with open(os.path.join(dst, MANIFEST_NAME), "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != MANIFEST_VERSION or manifest["params"] != params:
+            return {}
+        return manifest["files"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+def save_manifest(dst, files, params):
+    path = os.path.join(dst, MANIFEST_NAME)
+    with open(path + PART_SUFFIX, "w") as f:
+        json.dump(dict(version=MANIFEST_VERSION, params=params, files=files), f)
+    os.replace(path + PART_SUFFIX, path)
+
+def write_file(path, func):
+    # func(out) writes the file. A temporary file is used, so that an interrupted
+    # run does not leave a partially written file behind.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with open(path + PART_SUFFIX, "wb") as out:
+            func(out)
+    except BaseException:
+        os.unlink(path + PART_SUFFIX)
+        raise
+    os.replace(path + PART_SUFFIX, path)
+
+def encrypt_one(context, item):
+    # runs in a worker process, returns (number of bytes encrypted, error or None)
+    src, dst, session_key, header, chunk_size = context
+    rel = item[0]
+    aes = ChunkedAES(session_key, chunk_size)       # new nonce prefix
+    def encrypt(out):
+        out.write(header)
+        with open(os.path.join(src, rel), "rb") as inp:
+            aes.encrypt_file(inp, out, workers=1)
+    try:
+        write_file(os.path.join(dst, rel), encrypt)
+    except Exception as e:
+        return 0, "%s: %s" % (e.__class__.__name__, e)
+    return aes.InBytes, None
+
+SessionKeys = {}            # (key pair id, encrypted session key) -> session key, per process
+
+def decrypt_one(context, item):
+    # runs in a worker process, returns (number of bytes decrypted, error or None)
+    src, dst, keypair = context
+    rel = item[0]
+    try:
+        with open(os.path.join(src, rel), "rb") as inp:
+            version, enc_key = read_encrypted_key(keypair, inp)
+            session_key = SessionKeys.get((keypair.ID, enc_key))
+            if session_key is None:
+                session_key = RSA(keypair).decrypt(enc_key)
+                if len(session_key) != 16:
+                    raise ValueError("invalid session key")
+                SessionKeys[(keypair.ID, enc_key)] = session_key
+            if version in CBC_VERSIONS:
+                aes = AES(session_key)
+                write_file(os.path.join(dst, rel), lambda out: aes.decrypt_file(inp, out))
+            else:
+                aes = ChunkedAES.from_header(session_key, inp.read(ChunkedAES.HEADER_LENGTH))
+                write_file(os.path.join(dst, rel), lambda out: aes.decrypt_file(inp, out, workers=1))
+    except Exception as e:
+        return 0, "%s: %s" % (e.__class__.__name__, e)
+    return aes.OutBytes, None
+
+def process_tree(func, context, src, dst, params, workers=None, incremental=True, progress=None):
+    #
+    # params: parameters of the run, a JSON-compatible dict stored in the manifest
+    # progress(files done, files to do, bytes processed, seconds) is called after each file
+    # returns dict(files=..., skipped=..., bytes=..., seconds=..., errors=[(relative path, error), ...])
+    #
+    workers = workers or os.cpu_count() or 1
+    manifest = load_manifest(dst, params) if incremental else {}
+    items = []
+    nskipped = 0
+    for rel, size, mtime_ns in walk(src):
+        if manifest.get(rel) == [size, mtime_ns] and os.path.isfile(os.path.join(dst, rel)):
+            nskipped += 1
+        else:
+            items.append((rel, size, mtime_ns))
+    result = dict(files=0, skipped=nskipped, bytes=0, seconds=0.0, errors=[])
+    t0 = time.perf_counter()
+    try:
+        for i, ((rel, size, mtime_ns), (nbytes, error)) in enumerate(zip(items, parallel_map(func, context, items, workers, batch=BATCH))):
+            if error is None:
+                result["files"] += 1
+                result["bytes"] += nbytes
+                manifest[rel] = [size, mtime_ns]
+            else:
+                result["errors"].append((rel, error))
+                manifest.pop(rel, None)
+            result["seconds"] = time.perf_counter() - t0
+            if progress is not None:
+                progress(i+1, len(items), result["bytes"], result["seconds"])
+    finally:
+        os.makedirs(dst, exist_ok=True)
+        save_manifest(dst, manifest, params)
+    return result
+
+def encrypt_tree(key, src, dst, workers=None, incremental=True, progress=None, chunk_size=None):
+    # key: recipient public key or list of keys
+    keys = list(key) if isinstance(key, (list, tuple)) else [key]
+    aes = ChunkedAES(chunk_size=chunk_size)
+    if len(keys) == 1:
+        version = 2
+        header = key_header(RSA(keys[0]).encrypt(aes.Key))
+    else:
+        version = 3
+        header = recipients_header([(k.ID, RSA(k).encrypt(aes.Key)) for k in keys])
+    params = dict(operation="encrypt", recipients=sorted(k.ID for k in keys), format_version=version)
+    with stats.timer("bulk.encrypt_tree"):
+        return process_tree(encrypt_one, (src, dst, aes.Key, header, aes.ChunkSize), src, dst, params, 
+                workers, incremental, progress)
+
+def decrypt_tree(keypair, src, dst, workers=None, incremental=True, progress=None):
+    params = dict(operation="decrypt", key=keypair.ID)
+    with stats.timer("bulk.decrypt_tree"):
+        return process_tree(decrypt_one, (src, dst, keypair), src, dst, params, workers, incremental, progress)
@@ -0,0 +1,316 @@
+#
+# Encrypted file format: the file is encrypted with a random AES session key,
+# which is encrypted with the recipient's RSA public key and stored in front of
+# the encrypted data.
+#
+# Version 1:
+# length of the encrypted session key, 1 byte
+# encrypted session key
+# AES CBC stream, see AES.encrypt_file
+#
+# Version 2, written sequentially, can be written to and read from a pipe:
+# 0, 1 byte - never a valid length of an encrypted session key
+# version = 2, 1 byte
+# length of the encrypted session key, 2 bytes, big endian
+# encrypted session key
+# chunked AES GCM container, see ChunkedAES
+#
+# Version 3, several recipients sharing one encrypted payload:
+# 0, 1 byte
+# version = 3, 1 byte
+# number of recipients, 2 bytes, big endian
+# for each recipient:
+#   length of the recipient key id, 1 byte
+#   recipient key id, utf-8
+#   length of the encrypted session key, 2 bytes, big endian
+#   session key encrypted with the recipient's public key
+# chunked AES GCM container, see ChunkedAES
+#
+# Version 4, same as version 1 for session keys longer than 255 bytes (RSA keys of 2048 bits
+# and more):
+# 0, 1 byte
+# version = 4, 1 byte
+# length of the encrypted session key, 2 bytes, big endian
+# encrypted session key
+# AES CBC stream, see AES.encrypt_file
+#
+
+from tinyrsa.rsalib import RSA
+from tinyrsa.aes import AES, ChunkedAES
+from tinyrsa.formats import FORMAT_VERSION, CBC_VERSIONS
+from tinyrsa import stats
+
+import struct, os, stat, json, base64, hashlib
+
+def encrypt_file(key, inp, out, version=FORMAT_VERSION, workers=None, block_size=None):
+    # key: recipient public key or list of keys. Data is encrypted once for all recipients.
+    # returns the AES object used for encryption
+    keys = list(key) if isinstance(key, (list, tuple)) else [key]
+    if len(keys) > 1 and version == 2:
+        version = 3
+    if len(keys) > 1 and version in CBC_VERSIONS:
+        raise ValueError("Format version %d supports only one recipient" % (version,))
+    with stats.timer("envelope.encrypt_file"):
+        if version in CBC_VERSIONS:
+            if not is_regular_file(out):
+                raise ValueError("Format version %d can be written only to a regular file, use format version 2" % (version,))
+            aes = AES()
+            enc_key = RSA(keys[0]).encrypt(aes.Key)
+            if version == 1:
+                if len(enc_key) > 255:
+                    raise ValueError("Format version 1 does not support keys longer than 2040 bits, use format version 4")
+                out.write(bytes([len(enc_key)]))
+            else:
+                out.write(bytes([0, 4]) + struct.pack(">H", len(enc_key)))
+            out.write(enc_key)
+            aes.encrypt_file(inp, out, block_size)
+        elif version == 2:
+            aes = ChunkedAES(chunk_size=block_size)
+            out.write(key_header(RSA(keys[0]).encrypt(aes.Key)))
+            aes.encrypt_file(inp, out, workers)
+        elif version == 3:
+            aes = ChunkedAES(chunk_size=block_size)
+            out.write(recipients_header([(k.ID, RSA(k).encrypt(aes.Key)) for k in keys]))
+            aes.encrypt_file(inp, out, workers)
+        else:
+            raise ValueError("Unsupported format version: %s" % (version,))
+        return aes
+
+def is_regular_file(f):
+    # CBC formats update the header after the data is written, which needs a regular file
+    # or an in-memory buffer. Devices like /dev/null are seekable, but can not be truncated.
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return f.seekable()
+
+def key_header(enc_key):
+    # version 2 file header with the encrypted session key
+    return bytes([0, 2]) + struct.pack(">H", len(enc_key)) + enc_key
+
+def recipients_header(slots):
+    # version 3 file header, slots: [(recipient key id, encrypted session key), ...]
+    header = [bytes([0, 3]), struct.pack(">H", len(slots))]
+    for id, enc_key in slots:
+        id = id.encode("utf-8")
+        header += [bytes([len(id)]), id, struct.pack(">H", len(enc_key)), enc_key]
+    return b''.join(header)
+
+def read_version(inp):
+    # returns (version, length of the encrypted session key or number of recipients)
+    l = inp.read(1)[0]
+    if l != 0:
+        return 1, l
+    version = inp.read(1)[0]
+    if version not in (2, 3, 4):
+        raise ValueError("Unsupported format version: %s" % (version,))
+    l = struct.unpack(">H", inp.read(2))[0]
+    return version, l
+
+def read_encrypted_key(keypair, inp):
+    # reads the file header, returns (version, session key encrypted for the key pair)
+    version, l = read_version(inp)
+    if version == 3:
+        enc_key = None
+        for _ in range(l):
+            id = inp.read(inp.read(1)[0]).decode("utf-8")
+            data = inp.read(struct.unpack(">H", inp.read(2))[0])
+            if id == keypair.ID:
+                enc_key = data
+        if enc_key is None:
+            raise ValueError("The file is not encrypted for key %s" % (keypair.ID,))
+    else:
+        enc_key = inp.read(l)
+    return version, enc_key
+
+def read_session_key(keypair, inp):
+    # reads the file header, returns (version, decrypted session key)
+    version, enc_key = read_encrypted_key(keypair, inp)
+    return version, RSA(keypair).decrypt(enc_key)
+
+def decrypt_file(keypair, inp, out, workers=None, block_size=None):
+    # returns the AES object used for decryption
+    with stats.timer("envelope.decrypt_file"):
+        version, enc_key = read_session_key(keypair, inp)
+        if version in CBC_VERSIONS:
+            aes = AES(enc_key)
+            aes.decrypt_file(inp, out, block_size, workers)
+        else:
+            aes = ChunkedAES.from_header(enc_key, inp.read(ChunkedAES.HEADER_LENGTH))
+            aes.decrypt_file(inp, out, workers)
+        return aes
+
+#
+# Append mode: encrypts a growing file incrementally. The file is encrypted in format 
+# version 4 (AES CBC), which can be continued from its last ciphertext block. The session
+# key, the encrypted file layout and the identity (device and inode) and size of the input
+# file are kept in the state file, <output>.state by default, which must be kept secret and
+# is not needed to decrypt the file. Only the appended data is read and encrypted, and the
+# end of the previously encrypted input is compared with the encrypted file. If the state
+# file is missing, was made for another key or another input file, or the input file has
+# shrunk or its end has changed, the whole file is encrypted again.
+#
+# With verify_prefix, a hash of the whole encrypted part of the input is kept in the state
+# file as well, and each run reads the whole input to check it, so that changes anywhere 
+# in the input are detected.
+#
+
+APPEND_HASH = "sha256"
+
+def hash_input(inp, h, start, end, block_size=1024*1024):
+    # updates h with the input bytes [start, end), returns False if the input is shorter
+    inp.seek(start)
+    while start < end:
+        data = inp.read(min(block_size, end - start))
+        if not data:
+            return False
+        h.update(data)
+        start += len(data)
+    return True
+
+def append_file(key, input_path, output_path, state_path=None, block_size=None, verify_prefix=False):
+    # returns the AES object used for encryption
+    state_path = state_path or output_path + ".state"
+    with stats.timer("envelope.append_file"):
+        with open(input_path, "rb") as inp:
+            st = os.fstat(inp.fileno())
+            state = None
+            if os.path.isfile(state_path) and os.path.isfile(output_path):
+                with open(state_path, "r") as f:
+                    state = json.load(f)
+                if state.get("key_id") != key.ID or state.get("input") != [st.st_dev, st.st_ino] \
+                        or state["length"] > st.st_size \
+                        or (verify_prefix and "prefix_hash" not in state):
+                    state = None
+            h = hashlib.new(APPEND_HASH) if verify_prefix else None
+            if state is not None and verify_prefix:
+                if not hash_input(inp, h, 0, state["length"]) or h.hexdigest() != state["prefix_hash"]:
+                    state = None                # the encrypted part of the input was modified
+            if state is not None:
+                aes = AES(base64.b64decode(state["session_key"]))
+                data_start = state["data_start"]
+                with open(output_path, "r+b") as out:
+                    out.seek(data_start)
+                    if int.from_bytes(out.read(8), byteorder="big") != state["length"]:
+                        state = None            # the encrypted file was replaced
+                    else:
+                        out.seek(data_start)
+                        try:
+                            length = aes.append_file(inp, out, block_size)
+                        except ValueError:
+                            state = None        # the end of the input file was rewritten
+                if state is not None and verify_prefix and not hash_input(inp, h, state["length"], length):
+                    state = None
+            if state is None:
+                inp.seek(0)
+                h = hashlib.new(APPEND_HASH) if verify_prefix else None
+                with open(output_path, "w+b") as out:
+                    aes = encrypt_file(key, HashingReader(inp, h) if verify_prefix else inp, out, 4, 
+                            block_size=block_size)
+                    out.seek(2)
+                    data_start = 4 + struct.unpack(">H", out.read(2))[0]
+                    length = aes.InBytes
+        state = dict(key_id=key.ID, session_key=base64.b64encode(aes.Key).decode("utf-8"),
+                input=[st.st_dev, st.st_ino], data_start=data_start, length=length)
+        if verify_prefix:
+            state["prefix_hash"] = h.hexdigest()
+        fd = os.open(state_path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(state_path + ".tmp", state_path)
+        return aes
+
+#
+# Sealing: the file is encrypted and the plaintext is signed in one pass over the data.
+# The signature is the same as the one produced by RSA.sign for the plaintext.
+#
+
+class HashingReader(object):
+
+    def __init__(self, f, h):
+        self.File = f
+        self.Hash = h
+        if hasattr(f, "readinto"):
+            self.readinto = self.readinto_hashed
+
+    def readinto_hashed(self, b):
+        n = self.File.readinto(b)
+        if n:
+            self.Hash.update(memoryview(b)[:n])
+            stats.count("bytes_hashed", n)
+        return n
+
+    def read(self, n=-1):
+        data = self.File.read(n)
+        self.Hash.update(data)
+        stats.count("bytes_hashed", len(data))
+        return data
+
+class HashingWriter(object):
+
+    def __init__(self, f, h):
+        self.File = f
+        self.Hash = h
+
+    def write(self, data):
+        self.Hash.update(data)
+        stats.count("bytes_hashed", len(data))
+        return self.File.write(data)
+
+def seal_file(key, signer, inp, out, version=FORMAT_VERSION, workers=None, block_size=None, hash_method="sha3_256"):
+    # encrypts the file for the recipient key(s) and signs it with the signer key pair
+    # returns (signature, AES object used for encryption)
+    with stats.timer("envelope.seal_file"):
+        rsa = RSA(signer)
+        h, salt = rsa.signature_hash(hash_method)
+        aes = encrypt_file(key, HashingReader(inp, h), out, version, workers, block_size)
+        return rsa.signature_from_hash(h, salt), aes
+
+def open_sealed_file(keypair, signer, inp, out, signature, workers=None, block_size=None):
+    # decrypts the file and verifies the signature with the signer public key
+    # returns (True if the signature is valid, AES object used for decryption)
+    with stats.timer("envelope.open_sealed_file"):
+        h, expected = RSA(signer).verification_hash(signature)
+        aes = decrypt_file(keypair, inp, HashingWriter(out, h), workers, block_size)
+        return h.digest() == expected, aes
+
+class EncryptedFile(object):
+    #
+    # Random access to an encrypted file of either format. Only the part of 
+    # the file covering the requested range is read and decrypted.
+    #
+    
+    def __init__(self, f, keypair, workers=None):
+        self.File = f
+        self.Workers = workers
+        version, enc_key = read_session_key(keypair, f)
+        self.Version = version
+        if version in CBC_VERSIONS:
+            self.AES = AES(enc_key)
+            self.Length, self.DataStart = self.AES.read_header(f)
+            self.Size = self.Length
+        else:
+            self.AES = ChunkedAES.from_header(enc_key, f.read(ChunkedAES.HEADER_LENGTH))
+            self.DataStart = f.tell()
+            self.Length = os.fstat(f.fileno()).st_size - self.DataStart      # payload size
+            self.Size = self.AES.plaintext_size(self.Length)
+            
+    def read(self, offset=0, length=None):
+        if length is None:
+            length = max(0, self.Size - offset)
+        if self.Version in CBC_VERSIONS:
+            return self.AES.decrypt_range(self.File, self.DataStart, self.Length, offset, length)
+        else:
+            return self.AES.decrypt_range(self.File, self.DataStart, self.Length, offset, length, self.Workers)
+        
+    def close(self):
+        self.File.close()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *params):
+        self.close()
+        
+def open_encrypted(path, keypair, workers=None):
+    return EncryptedFile(open(path, "rb"), keypair, workers)
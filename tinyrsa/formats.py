@@ -0,0 +1,7 @@
+#
+# Encrypted file format versions, see envelope.py. Kept in a separate module, which
+# does not import the ciphers, for callers which only need the constants.
+#
+
+FORMAT_VERSION = 2
+CBC_VERSIONS = (1, 4)           # versions with AES CBC stream payload
@@ -0,0 +1,148 @@
+from tinyrsa.keys import KeyPair
+
+import os, threading, collections, fcntl
+
+class KeyPool(object):
+    #
+    # Keeps up to <depth> pre-generated key pairs of given size, either in memory
+    # or as key files in a spool directory:
+    #
+    #   <spool>/<size>/<key id>.json
+    #   <spool>/<size>/.lock
+    #
+    # The spool directory can be shared by several processes. Access to it is
+    # serialized with an flock() on the .lock file.
+    #
+    # When the pool drops below the low-water mark, a background thread
+    # generates new keys until the pool is full again.
+    #
+
+    def __init__(self, size=2048, depth=32, low_water=None, spool=None, workers=1, e=65537, background=True):
+        self.Size = size
+        self.Depth = depth
+        self.LowWater = depth//2 if low_water is None else low_water
+        self.Workers = workers
+        self.E = e
+        self.Keys = collections.deque()
+        self.SpoolDir = None
+        if spool is not None:
+            self.SpoolDir = os.path.join(spool, str(size))
+            os.makedirs(self.SpoolDir, mode=0o700, exist_ok=True)
+        self.Lock = threading.Lock()
+        self.Wakeup = threading.Condition()
+        self.Stop = False
+        self.Thread = None
+        if background:
+            self.start()
+
+    def generate(self):
+        return KeyPair.generate(self.Size, self.E, workers=self.Workers)
+
+    #
+    # spool directory
+    #
+
+    def spool_lock(self):
+        fd = os.open(os.path.join(self.SpoolDir, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def spool_unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def spool_files(self):
+        return sorted(fn for fn in os.listdir(self.SpoolDir) if fn.endswith(".json"))
+
+    def spool_put(self, kp):
+        path = os.path.join(self.SpoolDir, kp.ID + ".json")
+        tmp = os.path.join(self.SpoolDir, ".tmp-" + kp.ID)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(kp.as_json())
+        os.rename(tmp, path)         # atomic, so that readers never see a partial file
+
+    def spool_take(self):
+        fd = self.spool_lock()
+        try:
+            files = self.spool_files()
+            if not files:
+                return None
+            path = os.path.join(self.SpoolDir, files[0])
+            with open(path, "r") as f:
+                kp = KeyPair.from_json(f.read())
+            os.unlink(path)
+            return kp
+        finally:
+            self.spool_unlock(fd)
+
+    #
+    # pool interface
+    #
+
+    def count(self):
+        if self.SpoolDir is not None:
+            return len(self.spool_files())
+        else:
+            return len(self.Keys)
+
+    def put(self, kp):
+        if self.SpoolDir is not None:
+            self.spool_put(kp)
+        else:
+            with self.Lock:
+                self.Keys.append(kp)
+
+    def take(self):
+        if self.SpoolDir is not None:
+            kp = self.spool_take()
+        else:
+            with self.Lock:
+                kp = self.Keys.popleft() if self.Keys else None
+        self.wakeup()
+        if kp is None:
+            # pool is empty - generate the key in the request path
+            kp = self.generate()
+        return kp
+
+    def fill(self):
+        n = 0
+        while not self.Stop and self.count() < self.Depth:
+            self.put(self.generate())
+            n += 1
+        return n
+
+    #
+    # background refill
+    #
+
+    def wakeup(self):
+        with self.Wakeup:
+            self.Wakeup.notify()
+
+    def run(self):
+        while not self.Stop:
+            if self.count() <= self.LowWater:
+                self.fill()
+            with self.Wakeup:
+                if not self.Stop:
+                    self.Wakeup.wait(10.0)     # also re-check periodically, the spool can be shared
+
+    def start(self):
+        if self.Thread is None:
+            self.Stop = False
+            self.Thread = threading.Thread(target=self.run, daemon=True)
+            self.Thread.start()
+
+    def stop(self):
+        self.Stop = True
+        self.wakeup()
+        if self.Thread is not None:
+            self.Thread.join()
+            self.Thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        self.stop()
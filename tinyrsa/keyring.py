@@ -0,0 +1,363 @@
+#
+# Keyring: many keys in one binary file, with a hash index for O(1) lookup by key id.
+#
+# Data file <path>:
+#
+#   header: magic "TRKEYRNG", format version (2 bytes), reserved (6 bytes)
+#   records, appended one after another:
+#       magic "TRKR", 4 bytes
+#       flags, 1 byte: 1 - deleted, 2 - key pair
+#       key id length, 1 byte
+#       reserved, 2 bytes
+#       lengths of e, n, d, p, q, dp, dq, qinv, 2 bytes each, big endian (0 if absent)
+#       key id, utf-8
+#       e, n, d, p, q, dp, dq, qinv - unsigned, big endian
+#
+# CRT parameters are stored, so that loading a key pair does not compute anything.
+#
+# Deleting a key sets the "deleted" flag of its record in place.
+#
+# Index file <path>.idx, open addressing hash table, memory-mapped:
+#
+#   header: magic "TRKRIDX1", number of slots, number of used slots,
+#           size of the data file covered by the index - 8 bytes each
+#   slots: hash of key id (8 bytes, 0 - empty slot), record offset (8 bytes)
+#
+# If the data file size does not match the one recorded in the index, e.g. after
+# a crash between the two writes, the index is rebuilt from the data file. If the
+# rebuilt index can not be written, e.g. in a read-only directory, it is kept in memory.
+#
+# The files are opened read-only, and reopened for writing on the first add or delete.
+#
+
+from tinyrsa.keys import Key, KeyPair
+
+import struct, os, mmap, hashlib, fcntl
+
+FILE_HEADER = struct.Struct(">8sH6x")
+RECORD_HEADER = struct.Struct(">4sBBxx8H")
+INDEX_HEADER = struct.Struct(">8sQQQ")
+SLOT = struct.Struct(">QQ")
+
+FILE_MAGIC = b"TRKEYRNG"
+RECORD_MAGIC = b"TRKR"
+INDEX_MAGIC = b"TRKRIDX1"
+VERSION = 1
+
+DELETED = 1
+KEYPAIR = 2
+
+MIN_SLOTS = 1024
+
+def id_hash(id):
+    return int.from_bytes(hashlib.blake2b(id.encode("utf-8"), digest_size=8).digest(), "big") | 1
+
+def int_bytes(x):
+    return x.to_bytes((x.bit_length()+7)//8, "big") if x else b''
+
+def encode_record(key):
+    id = key.ID.encode("utf-8")
+    assert len(id) < 256
+    keypair = isinstance(key, KeyPair)
+    values = [key.E, key.N]
+    if keypair:
+        values += [key.D] + list(key.crt() or (0, 0, 0, 0, 0))
+    else:
+        values += [0]*6
+    parts = [int_bytes(x) for x in values]
+    header = RECORD_HEADER.pack(RECORD_MAGIC, KEYPAIR if keypair else 0, len(id), *[len(p) for p in parts])
+    return header + id + b''.join(parts)
+
+def decode_record(buf, offset):
+    # returns (flags, id, key, record size)
+    magic, flags, id_len, *lengths = RECORD_HEADER.unpack_from(buf, offset)
+    if magic != RECORD_MAGIC:
+        raise ValueError("Corrupted keyring record at %d" % (offset,))
+    i = offset + RECORD_HEADER.size
+    id = bytes(buf[i:i+id_len]).decode("utf-8")
+    i += id_len
+    values = []
+    for l in lengths:
+        values.append(int.from_bytes(buf[i:i+l], "big"))
+        i += l
+    e, n, d, p, q, dp, dq, qinv = values
+    if flags & KEYPAIR:
+        key = KeyPair(e, d, n, id=id)
+        if p:
+            key.P, key.Q, key.DP, key.DQ, key.QInv = p, q, dp, dq, qinv
+    else:
+        key = Key(e, n, id)
+    return flags, id, key, i - offset
+
+class Keyring(object):
+
+    def __init__(self, path, create=True):
+        self.Path = path
+        self.IndexPath = path + ".idx"
+        if not os.path.exists(path):
+            if not create:
+                raise FileNotFoundError(path)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            os.write(fd, FILE_HEADER.pack(FILE_MAGIC, VERSION))
+            os.close(fd)
+        self.File = open(path, "rb")
+        self.Writable = False
+        magic, version = FILE_HEADER.unpack(self.File.read(FILE_HEADER.size))
+        if magic != FILE_MAGIC or version != VERSION:
+            self.File.close()
+            raise ValueError("Not a keyring file: %s" % (path,))
+        self.Data = None
+        self.DataSize = 0
+        self.Index = None
+        self.IndexFile = None
+        self.open_index()
+
+    #
+    # locking and mapping
+    #
+
+    def lock(self, exclusive=False):
+        fcntl.flock(self.File.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def unlock(self):
+        fcntl.flock(self.File.fileno(), fcntl.LOCK_UN)
+
+    def data_size(self):
+        return os.fstat(self.File.fileno()).st_size
+
+    def map_data(self):
+        size = self.data_size()
+        if self.Data is None or size != self.DataSize:
+            if self.Data is not None:
+                self.Data.close()
+            self.Data = mmap.mmap(self.File.fileno(), size, access=mmap.ACCESS_READ)
+            self.DataSize = size
+        return self.Data
+
+    def open_for_writing(self):
+        # reopens the data file and the index for writing, before the first modification
+        if not self.Writable:
+            if self.Data is not None:
+                self.Data.close()
+                self.Data = None
+            self.File.close()
+            self.File = open(self.Path, "r+b")
+            self.Writable = True
+            self.open_index()
+
+    def open_index(self):
+        self.lock(exclusive=True)
+        try:
+            self.close_index()
+            valid = False
+            if os.path.exists(self.IndexPath):
+                with open(self.IndexPath, "rb") as f:
+                    header = f.read(INDEX_HEADER.size)
+                if len(header) == INDEX_HEADER.size:
+                    magic, nslots, nused, data_size = INDEX_HEADER.unpack(header)
+                    valid = magic == INDEX_MAGIC and data_size == self.data_size()
+            if not valid:
+                table = self.build_index()
+                try:
+                    self.write_index(table)
+                except OSError:
+                    if self.Writable:
+                        raise
+                    self.Index = table          # read-only: use the index in memory
+                    return
+            self.map_index()
+        finally:
+            self.unlock()
+
+    def map_index(self):
+        self.IndexFile = open(self.IndexPath, "r+b" if self.Writable else "rb")
+        self.Index = mmap.mmap(self.IndexFile.fileno(), 0,
+                access=mmap.ACCESS_WRITE if self.Writable else mmap.ACCESS_READ)
+
+    def close_index(self):
+        if self.IndexFile is not None:
+            self.Index.close()
+            self.IndexFile.close()
+            self.IndexFile = None
+        self.Index = None
+
+    def index_header(self):
+        return INDEX_HEADER.unpack_from(self.Index, 0)[1:]
+
+    #
+    # index
+    #
+
+    def scan(self):
+        # generates (offset, flags, id) for all records in the data file
+        data = self.map_data()
+        offset = FILE_HEADER.size
+        while offset < len(data):
+            flags, id, key, size = decode_record(data, offset)
+            yield offset, flags, id
+            offset += size
+
+    def build_index(self, nslots=None):
+        # returns the index built from the data file
+        entries = [(id_hash(id), offset) for offset, flags, id in self.scan() if not flags & DELETED]
+        nslots = max(nslots or 0, MIN_SLOTS)
+        while len(entries) * 2 > nslots:
+            nslots *= 2
+        table = bytearray(INDEX_HEADER.size + nslots * SLOT.size)
+        for h, offset in entries:
+            self.insert_slot(table, nslots, h, offset)
+        INDEX_HEADER.pack_into(table, 0, INDEX_MAGIC, nslots, len(entries), self.data_size())
+        return table
+
+    def write_index(self, table):
+        tmp = self.IndexPath + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(table)
+        os.rename(tmp, self.IndexPath)
+
+    @staticmethod
+    def insert_slot(table, nslots, h, offset):
+        i = h % nslots
+        while True:
+            pos = INDEX_HEADER.size + i * SLOT.size
+            if SLOT.unpack_from(table, pos)[0] == 0:
+                SLOT.pack_into(table, pos, h, offset)
+                return
+            i = (i + 1) % nslots
+
+    def find(self, id):
+        # returns offset of the live record with given id, or None
+        nslots = self.index_header()[0]
+        h = id_hash(id)
+        data = self.map_data()
+        i = h % nslots
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.Index, INDEX_HEADER.size + i * SLOT.size)
+            if slot_hash == 0:
+                return None
+            if slot_hash == h:
+                flags, record_id = RECORD_HEADER.unpack_from(data, offset)[1:3]
+                start = offset + RECORD_HEADER.size
+                if not flags & DELETED and bytes(data[start:start+record_id]).decode("utf-8") == id:
+                    return offset
+            i = (i + 1) % nslots
+
+    #
+    # keyring interface
+    #
+
+    def get(self, id, default=None):
+        self.lock()
+        try:
+            if INDEX_HEADER.unpack_from(self.Index, 0)[3] != self.data_size():
+                self.unlock()
+                self.open_index()           # modified by another process
+                self.lock()
+            offset = self.find(id)
+            if offset is None:
+                return default
+            return decode_record(self.map_data(), offset)[2]
+        finally:
+            self.unlock()
+
+    def __getitem__(self, id):
+        key = self.get(id)
+        if key is None:
+            raise KeyError(id)
+        return key
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def add(self, key):
+        # adds the key, replacing the key with the same id, if any. A key pair is not replaced
+        # with its public key: ValueError is raised instead
+        record = encode_record(key)
+        self.open_for_writing()
+        self.lock(exclusive=True)
+        try:
+            self.refresh_index()
+            offset = self.find(key.ID)
+            if offset is not None:
+                if self.map_data()[offset + 4] & KEYPAIR and not isinstance(key, KeyPair):
+                    raise ValueError("Key %s is a key pair in the keyring, not replaced with a public key" % (key.ID,))
+                self.mark_deleted(offset)
+            self.File.seek(0, 2)
+            offset = self.File.tell()
+            self.File.write(record)
+            self.File.flush()
+            nslots, nused, _ = self.index_header()
+            if (nused + 1) * 2 > nslots:
+                self.write_index(self.build_index(nslots * 2))
+                self.reopen_index()
+            else:
+                self.insert_slot(self.Index, nslots, id_hash(key.ID), offset)
+                INDEX_HEADER.pack_into(self.Index, 0, INDEX_MAGIC, nslots, nused + 1, self.data_size())
+                self.Index.flush()
+        finally:
+            self.unlock()
+
+    def delete(self, id):
+        self.open_for_writing()
+        self.lock(exclusive=True)
+        try:
+            self.refresh_index()
+            offset = self.find(id)
+            if offset is None:
+                return False
+            self.mark_deleted(offset)
+            return True
+        finally:
+            self.unlock()
+
+    def mark_deleted(self, offset):
+        # with the exclusive lock held
+        flags = self.map_data()[offset + 4]
+        self.File.seek(offset + 4)
+        self.File.write(bytes([flags | DELETED]))
+        self.File.flush()
+
+    def refresh_index(self):
+        # with the exclusive lock held
+        if self.index_header()[2] != self.data_size():
+            self.write_index(self.build_index(self.index_header()[0]))
+            self.reopen_index()
+
+    def reopen_index(self):
+        self.close_index()
+        self.map_index()
+
+    def ids(self):
+        self.lock()
+        try:
+            return [id for offset, flags, id in self.scan() if not flags & DELETED]
+        finally:
+            self.unlock()
+
+    def __iter__(self):
+        return iter(self.ids())
+
+    def __len__(self):
+        return len(self.ids())
+
+    def import_json(self, text):
+        key = Key.from_json(text)
+        self.add(key)
+        return key
+
+    def export_json(self, id):
+        return self[id].as_json()
+
+    def close(self):
+        if self.Data is not None:
+            self.Data.close()
+            self.Data = None
+        self.close_index()
+        self.File.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        self.close()
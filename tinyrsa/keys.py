@@ -1,7 +1,7 @@
-from tinyrsa.primes import generate_p_q, extended_gcd
-from tinyrsa.rnd import read_random_bytes
+from tinyrsa.primes import generate_p_q
+from tinyrsa import stats, bigint
     
-import json, base64, hashlib, uuid
+import json, base64
 
 def to_b64(x):
     nbytes = (x.bit_length()+7)//8
@@ -12,10 +12,25 @@ def from_b64(b):
 
 class Key(object):
 
-    def __init__(self, e, n, id):
+    def __init__(self, e, n, id, crt=None):
         self.E = e
         self.N = n
         self.ID = id
+        self.CRT = crt          # (p, q, dp, dq, qinv) for private keys with known factors
+        
+    def powmod(self, x):
+        stats.count("rsa.pow")
+        if self.CRT is None:
+            if self.E.bit_length() <= 32:
+                # public exponent: a few multiplications, not worth loading the big integer backend
+                return pow(x, self.E, self.N)
+            return bigint.powmod(x, self.E, self.N)
+        # Chinese Remainder Theorem: two half-size exponentiations instead of one full-size
+        p, q, dp, dq, qinv = self.CRT
+        m1 = bigint.powmod(x % p, dp, p)
+        m2 = bigint.powmod(x % q, dq, q)
+        h = (qinv * (m1 - m2)) % p
+        return m2 + h * q
         
     def as_jsonable(self):
         return dict(e=to_b64(self.E), n=to_b64(self.N), id=self.ID, type="key", 
@@ -52,15 +67,31 @@ class Key(object):
         
 class KeyPair(Key):
     
-    def __init__(self, e, d, n, id=None):
-        id = id or uuid.uuid1().hex
+    def __init__(self, e, d, n, id=None, p=None, q=None):
+        if not id:
+            import uuid
+            id = uuid.uuid1().hex
         Key.__init__(self, e, n, id)
         self.D = d              # private exponent
+        self.P = self.Q = self.DP = self.DQ = self.QInv = None
+        if p is not None and q is not None:
+            if p < q:   p, q = q, p
+            assert p * q == n
+            self.P, self.Q = p, q
+            self.DP = d % (p-1)
+            self.DQ = d % (q-1)
+            self.QInv = pow(q, -1, p)       # once per key, the big integer backend is not needed
         
     def as_jsonable(self):
         dct = Key.as_jsonable(self)
         dct["type"] = "keypair"
         dct["d"] = to_b64(self.D)
+        if self.P is not None:
+            dct["p"] = to_b64(self.P)
+            dct["q"] = to_b64(self.Q)
+            dct["dp"] = to_b64(self.DP)
+            dct["dq"] = to_b64(self.DQ)
+            dct["qinv"] = to_b64(self.QInv)
         return dct
 
     def as_json(self):
@@ -69,7 +100,10 @@ class KeyPair(Key):
     @staticmethod
     def from_jsonable(data):
         assert data["type"] == "keypair"
-        kp = KeyPair(from_b64(data["e"]), from_b64(data["d"]), from_b64(data["n"]), id=data["id"])
+        # p and q are optional - key files written by older versions do not have them
+        p = from_b64(data["p"]) if "p" in data else None
+        q = from_b64(data["q"]) if "q" in data else None
+        kp = KeyPair(from_b64(data["e"]), from_b64(data["d"]), from_b64(data["n"]), id=data["id"], p=p, q=q)
         return kp
         
     @staticmethod
@@ -78,9 +112,14 @@ class KeyPair(Key):
         assert dct["type"] == "keypair"
         return KeyPair.from_jsonable(dct)
         
+    def crt(self):
+        if self.P is None:
+            return None
+        return (self.P, self.Q, self.DP, self.DQ, self.QInv)
+        
     def private_key(self, format="key"):
         if format == "key":
-            return Key(self.D, self.N, self.ID)
+            return Key(self.D, self.N, self.ID, crt=self.crt())
         else:
             return (self.D, self.N)
             
@@ -91,14 +130,13 @@ class KeyPair(Key):
             return (self.E, self.N)
             
     @staticmethod
-    def generate(nbits=512, e=65537):
-        p, q = generate_p_q(nbits, e)
-        n = p * q
-        L = (p-1)*(q-1)
-        d = extended_gcd(e, L)[1]
-        private = (d, n, p, q, e)
-        public = (e, n)
-        return KeyPair(e, d, n)
+    def generate(nbits=512, e=65537, workers=1):
+        with stats.timer("keys.generate"):
+            p, q = generate_p_q(nbits, e, workers)
+            n = p * q
+            L = (p-1)*(q-1)
+            d = bigint.invert(e, L)
+            return KeyPair(e, d, n, p=p, q=q)
         
 if __name__ == "__main__":
     import random
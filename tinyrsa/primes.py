@@ -14,8 +14,22 @@
 
 # borrowed from: https://github.com/sybrenstuvel/python-rsa
 
-import math, random
+import math, random, os
 from tinyrsa.rnd import read_random_odd_int
+from tinyrsa import stats, bigint
+
+_numpy = False
+
+def numpy_module():
+    # NumPy is optional and slow to import, so it is imported on first use
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = None
+    return _numpy
 
 def miller_rabin_primality_testing(n):
     """Calculates whether n is composite (which is always correct) or prime
@@ -49,6 +63,13 @@ def miller_rabin_primality_testing(n):
     # prevent potential infinite loop when d = 0
     if n < 2:
         return False
+        
+    return bigint.is_probable_prime(n, k)
+    
+def miller_rabin(n, k):
+    """Pure Python Miller-Rabin test of n with k random witnesses, used by the
+    "python" big integer backend.
+    """
 
     # Decompose (n - 1) to write it as (2 ** r) * d
     # While d is even, divide it by 2 and increase the exponent.
@@ -61,15 +82,16 @@ def miller_rabin_primality_testing(n):
 
     # Test k witnesses.
     for _ in range(k):
+        stats.count("primes.miller_rabin_rounds")
         # Generate random integer a, where 2 <= a <= (n - 2)
         a = random.randint(2, n - 2)
 
-        x = pow(a, d, n)
+        x = bigint.powmod(a, d, n)
         if x == 1 or x == n - 1:
             continue
 
         for _ in range(r - 1):
-            x = pow(x, 2, n)
+            x = bigint.powmod(x, 2, n)
             if x == 1:
                 # n is composite.
                 return False
@@ -92,7 +114,8 @@ primes_100 = [3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 6
 primes_100_set = set(primes_100)
 last_prime_100 = max(primes_100)
 
-def is_prime(x):
+def is_prime_mr(x):
+    # trial division by small primes, then Miller-Rabin with random witnesses
     if x < 2: return False
     if x == 2: return True
     if x & 1 == 0: return False
@@ -104,11 +127,227 @@ def is_prime(x):
         return True
     return miller_rabin_primality_testing(x)
     
+SIEVE_PRIMES_LIMIT = 1 << 16      # sieve candidates with all odd primes below this
+SIEVE_WINDOW = 4096                 # number of odd candidates sieved from one random start
+SIEVE_MIN_BITS = 32                 # smaller primes are searched for by trial division
+
+_sieve_primes = None
+_sieve_primes_array = None
+
+def sieve_primes():
+    """Returns the list of odd primes below SIEVE_PRIMES_LIMIT, computed once"""
+    global _sieve_primes, _sieve_primes_array
+    if _sieve_primes is None:
+        n = SIEVE_PRIMES_LIMIT
+        flags = bytearray([1]) * n
+        flags[0:2] = b'\0\0'
+        for i in range(2, int(n**0.5)+1):
+            if flags[i]:
+                flags[i*i::i] = bytes(len(range(i*i, n, i)))
+        _sieve_primes = [i for i in range(3, n) if flags[i]]
+        np = numpy_module()
+        if np is not None:
+            _sieve_primes_array = np.array(_sieve_primes, dtype=np.int64)
+    return _sieve_primes
+
+def sieve_window_python(start, window):
+    # flags[i] == 1 means start + 2*i has no small prime factors
+    flags = bytearray([1]) * window
+    for p in sieve_primes():
+        # solve start + 2*i = 0 mod p for i; (p+1)//2 is the inverse of 2 mod p
+        i = (-(start % p) * ((p+1)//2)) % p
+        if i < window:
+            flags[i::p] = bytes(len(range(i, window, p)))
+    return [i for i in range(window) if flags[i]]
+    
+def sieve_window_numpy(start, window):
+    np = numpy_module()
+    sieve_primes()
+    primes = _sieve_primes_array
+    # start mod p for all p at once, by Horner's scheme over 16-bit limbs of start
+    nlimbs = (start.bit_length() + 15)//16
+    residues = np.zeros(len(primes), dtype=np.int64)
+    for j in range(nlimbs-1, -1, -1):
+        limb = (start >> (16*j)) & 0xFFFF
+        residues = (residues * 0x10000 + limb) % primes
+    offsets = (-residues * ((primes+1)//2)) % primes
+    flags = np.ones(window, dtype=bool)
+    small = primes < window
+    for p, i in zip(primes[small].tolist(), offsets[small].tolist()):
+        flags[i::p] = False
+    large = offsets[~small]
+    flags[large[large < window]] = False
+    return np.flatnonzero(flags).tolist()
+
+def sieve_window(start, window=SIEVE_WINDOW):
+    """Returns the list of offsets i, 0 <= i < window, such that start + 2*i 
+    is not divisible by any odd prime below SIEVE_PRIMES_LIMIT. 
+    start must be odd and greater than SIEVE_PRIMES_LIMIT.
+    """
+    if numpy_module() is not None:
+        return sieve_window_numpy(start, window)
+    else:
+        return sieve_window_python(start, window)
+
+#
+# Baillie-PSW primality test: most composites are rejected by a gcd with the product 
+# of odd primes below 2**8, and then by a gcd with the product of the primes from 2**8 
+# to 2**13 (about a thousand primes). Survivors get a strong probable prime test to 
+# base 2 followed by a strong Lucas probable prime test with Selfridge parameters.
+# No composite passing both tests is known.
+#
+
+PRIMORIAL_LIMITS = [1 << 8, 1 << 13]
+
+_primorials = None
+
+def primorials():
+    # products of the odd primes between consecutive PRIMORIAL_LIMITS
+    global _primorials
+    if _primorials is None:
+        _primorials = []
+        low = 0
+        for limit in PRIMORIAL_LIMITS:
+            _primorials.append(math.prod(p for p in sieve_primes() if low <= p < limit))
+            low = limit
+    return _primorials
+
+def strong_probable_prime_base_2(n):
+    d = n - 1
+    s = 0
+    while not (d & 1):
+        s += 1
+        d >>= 1
+    x = bigint.powmod(2, d, n)
+    if x == 1 or x == n - 1:
+        return True
+    for _ in range(s - 1):
+        x = x * x % n
+        if x == n - 1:
+            return True
+    return False
+
+def jacobi(a, n):
+    # Jacobi symbol (a/n) for odd positive n
+    a %= n
+    result = 1
+    while a:
+        while not (a & 1):
+            a >>= 1
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+def half_mod(x, n):
+    # x/2 mod n for odd n
+    x %= n
+    if x & 1:
+        x += n
+    return x >> 1
+
+def strong_lucas_probable_prime(n):
+    r = math.isqrt(n)
+    if r * r == n:
+        return False        # no suitable D exists for perfect squares
+    # Selfridge method A: first D in 5, -7, 9, -11, ... with (D/n) = -1
+    D = 5
+    while True:
+        j = jacobi(D, n)
+        if j == -1:
+            break
+        if j == 0 and abs(D) != n:
+            return False
+        D = -D - 2 if D > 0 else -D + 2
+    P, Q = 1, (1 - D)//4
+    
+    # n + 1 = d * 2**s, d odd
+    d = n + 1
+    s = 0
+    while not (d & 1):
+        s += 1
+        d >>= 1
+        
+    # U_d, V_d and Q**d mod n, by binary expansion of d
+    U, V, Qk = 1, P, Q % n
+    for bit in bin(d)[3:]:
+        U = U * V % n
+        V = (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if bit == "1":
+            U, V = half_mod(P * U + V, n), half_mod(D * U + P * V, n)
+            Qk = Qk * Q % n
+            
+    if U == 0 or V == 0:
+        return True
+    for _ in range(s - 1):
+        V = (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if V == 0:
+            return True
+    return False
+    
+def bpsw(n):
+    # the probable prime tests of Baillie-PSW, for odd n without small factors
+    return strong_probable_prime_base_2(n) and strong_lucas_probable_prime(n)
+
+def is_prime_bpsw(x):
+    if x < 2: return False
+    if x == 2: return True
+    if x & 1 == 0: return False
+    for product in primorials():
+        if bigint.gcd(x, product) != 1:
+            return x < PRIMORIAL_LIMITS[-1] and is_prime_mr(x)        # exact for small x
+    if x < PRIMORIAL_LIMITS[-1]**2:
+        return True
+    return bpsw(x)
+    
+#
+# Primality test engines. Each has a full test and a test for sieved candidates,
+# which are known to have no small prime factors.
+#
+
+PrimalityTests = {
+    "mr":       (is_prime_mr, miller_rabin_primality_testing),
+    "bpsw":     (is_prime_bpsw, bpsw)
+}
+
+PrimalityTest = None
+_probable_prime = None
+
+def set_primality_test(name):
+    global PrimalityTest, _probable_prime
+    if name not in PrimalityTests:
+        raise ValueError("Unknown primality test: %s" % (name,))
+    PrimalityTest = name
+    _probable_prime = PrimalityTests[name][1]
+    
+def is_prime(x, test=None):
+    return PrimalityTests[test or PrimalityTest][0](x)
+
+set_primality_test(os.environ.get("TINYRSA_PRIMALITY", "mr"))
+
 def get_prime(nbits):
-    x = read_random_odd_int(nbits)
-    while not is_prime(x):
-        x = read_random_odd_int(nbits)
-    return x
+    with stats.timer("primes.get_prime"):
+        if nbits < SIEVE_MIN_BITS:
+            x = read_random_odd_int(nbits)
+            while not is_prime(x):
+                x = read_random_odd_int(nbits)
+            return x
+        
+        while True:
+            start = read_random_odd_int(nbits)
+            stats.count("primes.sieve_windows")
+            for i in sieve_window(start):
+                x = start + 2*i
+                if x.bit_length() > nbits:
+                    break
+                stats.count("primes.candidates")
+                if _probable_prime(x):
+                    return x
 
 def extended_gcd(a, b):
     """Returns a tuple (r, i, j) such that r = gcd(a, b) = ia + jb
@@ -142,10 +381,25 @@ def gcd(p, q):
         (p, q) = (q, p % q)
     return p
 
-def generate_p_q(length, e):
+def p_q_bits(length):
     nbits = length//2
     pbits = nbits + nbits//16
     qbits = nbits - nbits//16
+    return pbits, qbits
+    
+def good_p_q(p, q, length, e):
+    if (p*q).bit_length() != length:
+        return False
+    if p <= q: 
+        return False
+    L = (p-1)*(q-1)
+    return bigint.gcd(L, e) == 1
+
+def generate_p_q(length, e, workers=1):
+    if workers is not None and workers > 1:
+        return generate_p_q_parallel(length, e, workers)
+        
+    pbits, qbits = p_q_bits(length)
     
     done = False
     #print("bits:", pbits, qbits)
@@ -160,16 +414,45 @@ def generate_p_q(length, e):
         change_p = not change_p
             
         #print("canditates:", p, q)
-        if (p*q).bit_length() != length:
-            #print("wrong length", (p*q).bit_length())
-            continue
-        if p <= q: continue
-            
-        L = (p-1)*(q-1)
+        if good_p_q(p, q, length, e):
+            return p, q
+
+def generate_p_q_parallel(length, e, workers):
+    #
+    # Each worker process searches for one prime of the requested size at a time.
+    # Found primes are matched against the primes of the other kind found so far,
+    # and as soon as a good pair is found, the remaining workers are terminated.
+    #
+    import multiprocessing, queue
+    pbits, qbits = p_q_bits(length)
+    found = queue.Queue()
+    ps, qs = [], []
+    pool = multiprocessing.Pool(workers)
+    try:
+        def submit(kind):
+            # kind: "p" or "q", tracked per task, because p and q can have the same size
+            pool.apply_async(get_prime, (pbits if kind == "p" else qbits,), 
+                callback=lambda x: found.put((kind, x)), 
+                error_callback=lambda exc: found.put((None, exc)))
         
-        if gcd(L, e) != 1:
-            #print("L not coprime with e")
-            continue
+        for i in range(workers):
+            submit("p" if i % 2 == 0 else "q")
         
-        return p, q
-
+        while True:
+            kind, x = found.get()
+            if kind is None:
+                raise x
+            submit(kind)
+            if kind == "p":
+                for q in qs:
+                    if good_p_q(x, q, length, e):
+                        return x, q
+                ps.append(x)
+            else:
+                for p in ps:
+                    if good_p_q(p, x, length, e):
+                        return p, x
+                qs.append(x)
+    finally:
+        pool.terminate()
+        pool.join()
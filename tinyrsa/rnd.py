@@ -21,6 +21,41 @@
 
 import os
 import struct
+import threading
+
+class EntropyPool(object):
+    """Serves random bytes from a buffer refilled with large os.urandom() reads.
+
+    The buffer is discarded in the child after fork(), so that processes never
+    share random bytes.
+    """
+
+    def __init__(self, size: int = 4096) -> None:
+        self.Size = size
+        self.Lock = threading.Lock()
+        self.Buffer = b''
+        self.Pos = 0
+
+    def reset(self) -> None:
+        self.Lock = threading.Lock()
+        self.Buffer = b''
+        self.Pos = 0
+
+    def read(self, nbytes: int) -> bytes:
+        if nbytes >= self.Size:
+            return os.urandom(nbytes)
+        with self.Lock:
+            if self.Pos + nbytes > len(self.Buffer):
+                self.Buffer = os.urandom(self.Size)
+                self.Pos = 0
+            data = self.Buffer[self.Pos:self.Pos+nbytes]
+            self.Pos += nbytes
+            return data
+
+pool = EntropyPool()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=pool.reset)
 
 def read_random_bits(nbits: int) -> bytes:
     """Reads 'nbits' random bits.
@@ -32,18 +67,18 @@ def read_random_bits(nbits: int) -> bytes:
     nbytes, rbits = divmod(nbits, 8)
 
     # Get the random bytes
-    randomdata = os.urandom(nbytes)
+    randomdata = pool.read(nbytes)
 
     # Add the remaining random bits
     if rbits > 0:
-        randomvalue = ord(os.urandom(1))
+        randomvalue = ord(pool.read(1))
         randomvalue >>= (8 - rbits)
         randomdata = struct.pack("B", randomvalue) + randomdata
 
     return randomdata
 
 def read_random_bytes(nbytes):
-    return os.urandom(nbytes)
+    return pool.read(nbytes)
 
 def read_random_int(nbits: int) -> int:
     """Reads a random integer of approximately nbits bits.
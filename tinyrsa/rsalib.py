@@ -1,7 +1,191 @@
 from tinyrsa.rnd import read_random_int, read_random_bytes
-from tinyrsa.keys import to_b64, from_b64
+from tinyrsa import stats
     
-import hashlib, base64
+import hashlib, base64, collections, itertools, os, mmap, stat
+
+def pad(data):
+    z = 0
+    while z == 0:
+        z = read_random_int(8)
+    return int.from_bytes(bytes([z]) + data, byteorder="big", signed=False)
+    
+def unpad(x):
+    data_bytes = (x.bit_length()+7)//8
+    return x.to_bytes(data_bytes, byteorder="big")[1:]
+
+def rsa(x, key):
+    n = key.N
+    if x < n:
+        # short message, single block
+        return key.powmod(x)
+    ys = []
+    while x:
+        x, r = divmod(x, n)
+        yy = key.powmod(r)
+        #print("rsa: r:", r, " -> yy:", yy)
+        ys.append(yy)
+    y = 0
+    for yy in ys[::-1]:
+        y = y * n + yy
+    return y
+    
+def encrypt_message(key, data):
+    y = rsa(pad(data), key)
+    y_bytes = (y.bit_length() + 7)//8
+    return y.to_bytes(y_bytes, byteorder="big")
+    
+def decrypt_message(key, data):
+    y = int.from_bytes(data, byteorder="big")
+    #print("decrypt: y bits:", y.bit_length())
+    return unpad(rsa(y, key))
+
+#
+# Block mode: the input is split into blocks of key.nbytes()-2 bytes. Each block is
+# padded with one random non-zero byte and encrypted into a ciphertext block of exactly
+# key.nbytes() bytes. Only the last block can be shorter than the others. Blocks are 
+# independent, so they can be processed in parallel.
+#
+
+def encrypt_block(key, data):
+    return key.powmod(pad(data)).to_bytes(key.nbytes(), byteorder="big")
+    
+def decrypt_block(key, block):
+    return unpad(key.powmod(int.from_bytes(block, byteorder="big")))
+    
+def read_blocks(data_source, size):
+    # splits bytes, a file-like object or an iterable of bytes into blocks of given size
+    if isinstance(data_source, str):
+        data_source = data_source.encode("utf-8")
+    if isinstance(data_source, (bytes, bytearray)):
+        for i in range(0, len(data_source), size):
+            yield bytes(data_source[i:i+size])
+    elif hasattr(data_source, "read"):
+        data = data_source.read(size)
+        while data:
+            while len(data) < size:
+                more = data_source.read(size - len(data))
+                if not more:    break
+                data += more
+            yield data
+            data = data_source.read(size)
+    else:
+        buf = bytearray()
+        for data in data_source:
+            buf += data
+            if len(buf) >= size:
+                n = len(buf) // size * size
+                for i in range(0, n, size):
+                    yield bytes(buf[i:i+size])
+                del buf[:n]             # one move per input item, not per block
+        if buf:
+            yield bytes(buf)
+        
+def apply_batch(func, key, batch):
+    return [func(key, item) for item in batch]
+        
+def parallel_map(func, key, items, workers=None, executor=None, batch=64, window=None):
+    # Ordered map of func(key, item) over items, which can be an iterator of unknown length.
+    # Items are sent to the executor in batches, at most <window> batches are in flight.
+    if executor is None and (workers is None or workers <= 1):
+        for item in items:
+            yield func(key, item)
+        return
+    own_executor = executor is None
+    if own_executor:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(workers)
+    window = window or 2*(workers or 8)
+    pending = collections.deque()
+    try:
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, batch))
+            if not chunk:
+                break
+            pending.append(executor.submit(apply_batch, func, key, chunk))
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for f in pending:
+            f.cancel()
+        if own_executor:
+            executor.shutdown()
+
+#
+# Tree hash: the input is split into fixed-size chunks, which are hashed independently
+# and combined into a Merkle tree:
+#
+#   leaf = H(0x00 + chunk)
+#   node = H(0x01 + left + right), an odd node is promoted to the next level as is
+#
+# Empty input is hashed as a single empty chunk.
+#
+# A tree signature signs H("tree-<chunk size>-<hash method>" + salt + root), so that
+# the chunk size and the mode are covered by the signature too. A plain signature signs
+# H(salt + data): the tag in front of the random salt keeps the two kinds of signatures
+# apart. Chunks smaller than MIN_TREE_CHUNK are rejected.
+#
+
+MIN_TREE_CHUNK = 4096
+
+def hash_leaf(method, chunk):
+    stats.count("bytes_hashed", len(chunk))
+    h = hashlib.new(method)
+    h.update(b'\x00')
+    h.update(chunk)
+    return h.digest()
+    
+def merkle_root(method, leaves):
+    if not leaves:
+        leaves = [hash_leaf(method, b'')]
+    while len(leaves) > 1:
+        level = []
+        for i in range(0, len(leaves)-1, 2):
+            h = hashlib.new(method)
+            h.update(b'\x01' + leaves[i] + leaves[i+1])
+            level.append(h.digest())
+        if len(leaves) % 2:
+            level.append(leaves[-1])
+        leaves = level
+    return leaves[0]
+    
+def file_chunks(f, chunk_size):
+    # returns a list of memoryviews of a memory-mapped regular file, from the current 
+    # position to the end, or None if the file can not be memory-mapped
+    try:
+        fd = f.fileno()
+        pos = f.tell()
+        st = os.fstat(fd)
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None                 # pipes, devices, /proc files: the size is not reliable
+    size = st.st_size
+    if size <= pos:
+        return []
+    m = memoryview(mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+    return [m[i:i+chunk_size] for i in range(pos, size, chunk_size)]
+
+def tree_hash(method, data_source, chunk_size, workers=None, executor=None):
+    if isinstance(data_source, os.PathLike):
+        with open(data_source, "rb") as f:
+            return tree_hash(method, f, chunk_size, workers, executor)
+    chunks = None
+    if hasattr(data_source, "fileno"):
+        chunks = file_chunks(data_source, chunk_size)
+    if chunks is None:
+        chunks = read_blocks(data_source, chunk_size)
+    own_executor = executor is None
+    if own_executor:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(workers or os.cpu_count() or 1)
+    try:
+        return merkle_root(method, list(parallel_map(hash_leaf, method, chunks, executor=executor, batch=1)))
+    finally:
+        if own_executor:
+            executor.shutdown()
 
 class RSA(object):
     
@@ -9,82 +193,176 @@ class RSA(object):
         self.Key = key
 
     def pad(self, data):
-        z = 0
-        while z == 0:
-            z = read_random_int(8)
-        return int.from_bytes(bytes([z]) + data, byteorder="big", signed=False)
+        return pad(data)
         
     def unpad(self, x):
-        data_bytes = (x.bit_length()+7)//8
-        return x.to_bytes(data_bytes, byteorder="big")[1:]
-        
-    def rsa(self, x, e, n):
-        ys = []
-        x0 = x
-        while x:
-            x, r = divmod(x, n)
-            yy = pow(r, e, n)
-            #print("rsa: r:", r, " -> yy:", yy)
-            ys.append(yy)
-        y = 0
-        for yy in ys[::-1]:
-            y = y * n + yy
-        #print("rsa: %x -> %x" % (x0, y))
-        return y
+        return unpad(x)
+        
+    def rsa(self, x, key):
+        return rsa(x, key)
         
     def encrypt(self, data, key=None):
         if key is None: key = self.Key      # use public key by default
-        x = self.pad(data)
-        e, n = key.E, key.N
-        y = self.rsa(x, e, n)
-        y_bytes = (y.bit_length() + 7)//8
-        return y.to_bytes(y_bytes, byteorder="big")
+        return encrypt_message(key, data)
         
     def decrypt(self, data, key=None):
         if key is None: key = self.Key.private_key()    # use private key by default
-        y = int.from_bytes(data, byteorder="big")
-        #print("decrypt: y bits:", y.bit_length())
-        d, n = key.E, key.N
-        x = self.rsa(y, d, n)
-        return self.unpad(x)
+        return decrypt_message(key, data)
+        
+    def encrypt_many(self, messages, key=None, workers=None, executor=None):
+        # generates encrypted messages in the same order
+        if key is None: key = self.Key
+        return parallel_map(encrypt_message, key, messages, workers=workers, executor=executor)
+        
+    def decrypt_many(self, messages, key=None, workers=None, executor=None):
+        # generates decrypted messages in the same order
+        if key is None: key = self.Key.private_key()
+        return parallel_map(decrypt_message, key, messages, workers=workers, executor=executor)
+        
+    def encrypt_blocks(self, data_source, key=None, workers=None, executor=None):
+        # generates ciphertext blocks, key.nbytes() bytes each
+        if key is None: key = self.Key
+        return parallel_map(encrypt_block, key, read_blocks(data_source, key.nbytes()-2), 
+                workers=workers, executor=executor)
+    
+    def decrypt_blocks(self, data_source, key=None, workers=None, executor=None):
+        # generates decrypted data blocks
+        if key is None: key = self.Key.private_key()
+        return parallel_map(decrypt_block, key, read_blocks(data_source, key.nbytes()), 
+                workers=workers, executor=executor)
         
     SIGNATURE_SALT = 64 # bytes
     
+    HASH_BLOCK_SIZE = 256*1024      # large reads let hashlib release the GIL for longer
+    
     def hash_data(self, h, data_source):
         if isinstance(data_source, str):
             data_source = data_source.encode("utf-8")
         if isinstance(data_source, bytes):
             h.update(data_source)
+            stats.count("bytes_hashed", len(data_source))
+        elif isinstance(data_source, os.PathLike):
+            with open(data_source, "rb") as f:
+                self.hash_data(h, f)
         elif hasattr(data_source, "read"):
             data = b" "
             while data:
-                data = data_source.read(8*1024)
+                data = data_source.read(self.HASH_BLOCK_SIZE)
                 if data:
                     h.update(data)
+                    stats.count("bytes_hashed", len(data))
         else:
             for data in data_source:
                 h.update(data)
+                stats.count("bytes_hashed", len(data))
+
+    TREE_CHUNK_SIZE = 4*1024*1024
 
-    def sign(self, data_source, hash_metbhod="sha3_256"):
+    @staticmethod
+    def check_tree_chunk(tree_chunk):
+        if tree_chunk < MIN_TREE_CHUNK:
+            raise ValueError("Tree chunk size %d is less than the minimum of %d" % (tree_chunk, MIN_TREE_CHUNK))
+
+    def sign(self, data_source, hash_metbhod="sha3_256", tree_chunk=None, workers=None):
+        #
+        # with tree_chunk, the data is hashed as a tree of chunks of that size, in parallel,
+        # and the signature method is recorded as "tree-<chunk size>-<hash method>"
+        #
+        with stats.timer("rsa.sign"):
+            if tree_chunk:
+                self.check_tree_chunk(tree_chunk)
+                method = "tree-%d-%s" % (tree_chunk, hash_metbhod)
+                h, salt = self.signature_hash(hash_metbhod, method)
+                h.update(tree_hash(hash_metbhod, data_source, tree_chunk, workers))
+            else:
+                h, salt = self.signature_hash(hash_metbhod)
+                self.hash_data(h, data_source)
+                method = hash_metbhod
+            return self.signature_from_hash(h, salt, method)
+        
+    #
+    # Signing and verification in steps, for callers feeding the data to the hash themselves:
+    #
+    #   h, salt = rsa.signature_hash()
+    #   h.update(...)
+    #   signature = rsa.signature_from_hash(h, salt)
+    #
+    #   h, expected = rsa.verification_hash(signature)
+    #   h.update(...)
+    #   ok = h.digest() == expected
+    #
+        
+    def signature_hash(self, hash_metbhod="sha3_256", tag=None):
+        # tag: signature method of a tree signature, hashed in front of the salt
         salt = read_random_bytes(self.SIGNATURE_SALT)
         h = hashlib.new(hash_metbhod)
+        if tag:
+            h.update(tag.encode("utf-8"))
         h.update(salt)
-        self.hash_data(h, data_source)
+        return h, salt
+        
+    def signature_from_hash(self, h, salt, method=None):
         digest = h.digest() + salt
         signed = base64.b64encode(self.encrypt(digest, self.Key.private_key()))
-        return hash_metbhod + ":" + signed.decode("utf-8")
-    
-    def verify_signature(self, data_source, signature):
+        return (method or h.name) + ":" + signed.decode("utf-8")
+        
+    def parse_signature(self, signature):
+        # returns (hash method, tree chunk size or None, hash object with salt applied, expected digest)
         assert isinstance(signature, str)
-        method, encrypted_digest = signature.split(":", 1)
+        tag, encrypted_digest = signature.split(":", 1)
+        method, tree_chunk = tag, None
+        if tag.startswith("tree-"):
+            _, tree_chunk, method = tag.split("-", 2)
+            tree_chunk = int(tree_chunk)
+            self.check_tree_chunk(tree_chunk)
         encrypted_digest = base64.b64decode(encrypted_digest)
         digest = self.decrypt(encrypted_digest, self.Key.public_key())
         h = hashlib.new(method)
         hash, salt = digest[:h.digest_size], digest[h.digest_size:]
-        h = hashlib.new(method)
+        if tree_chunk:
+            h.update(tag.encode("utf-8"))
         h.update(salt)
-        self.hash_data(h, data_source)
-        return hash == h.digest()
+        return method, tree_chunk, h, hash
+        
+    def verification_hash(self, signature):
+        method, tree_chunk, h, hash = self.parse_signature(signature)
+        if tree_chunk:
+            raise ValueError("Tree hash signatures can not be verified incrementally")
+        return h, hash
+    
+    def verify_signature(self, data_source, signature, workers=None):
+        with stats.timer("rsa.verify_signature"):
+            method, tree_chunk, h, hash = self.parse_signature(signature)
+            if tree_chunk:
+                h.update(tree_hash(method, data_source, tree_chunk, workers))
+            else:
+                self.hash_data(h, data_source)
+            return hash == h.digest()
+        
+    def verify_many(self, items, workers=None, executor=None):
+        #
+        # items: iterable of (data_source, signature) tuples. To avoid opening all the files
+        # at once, data sources can be given as os.PathLike objects, e.g. pathlib.Path.
+        # Generates True/False for each item, in the same order. Hashing runs in a thread pool.
+        # An item which can not be verified, e.g. with a malformed signature or a missing file,
+        # is reported as False and does not stop the batch.
+        #
+        def verify(_, item):
+            data_source, signature = item
+            try:
+                return self.verify_signature(data_source, signature)
+            except Exception:
+                return False
+        own_executor = executor is None
+        if own_executor:
+            from concurrent.futures import ThreadPoolExecutor
+            workers = workers or os.cpu_count() or 1
+            executor = ThreadPoolExecutor(workers)
+        try:
+            yield from parallel_map(verify, None, items, executor=executor, batch=1, window=4*(workers or 8))
+        finally:
+            if own_executor:
+                executor.shutdown()
         
 if __name__ == "__main__":
     
@@ -0,0 +1,109 @@
+#
+# Key server: a long-running process which loads keys once and performs operations
+# with them on request, over a Unix socket.
+#
+# Protocol: newline-separated JSON objects. Each request
+#
+#   {"op": "encrypt"|"decrypt"|"sign"|"verify", "key": <key file path or key id>, "args": {...}}
+#
+# "key" of an encrypt request can also be a list of recipient keys.
+#
+# gets a response
+#
+#   {"ok": true, "result": ...}   or   {"ok": false, "error": "..."}
+#
+# Data is passed as file paths, which are read and written by the server process.
+#
+
+from tinyrsa.keys import Key
+from tinyrsa.rsalib import RSA
+from tinyrsa.formats import FORMAT_VERSION
+
+import socketserver, socket, json, os, stat
+
+class KeyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, key_files):
+        self.Keys = {}
+        for key_file in key_files:
+            with open(key_file, "r") as f:
+                key = Key.from_json(f.read())
+            self.Keys[os.path.realpath(key_file)] = key
+            self.Keys[key.ID] = key
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError("%s exists and is not a socket" % (path,))
+            os.unlink(path)             # left over from a previous run
+        umask = os.umask(0o077)         # the socket is accessible only by the owner
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def key(self, name, private=False):
+        key = self.Keys.get(name) or self.Keys.get(os.path.realpath(name))
+        if key is None:
+            raise KeyError("Key not loaded: %s" % (name,))
+        if private and not hasattr(key, "D"):
+            raise ValueError("Key %s is not a key pair" % (name,))
+        return key
+
+    def do_encrypt(self, key, input, output, version=FORMAT_VERSION, workers=None):
+        from tinyrsa import envelope
+        with open(input, "rb") as inp, open(output, "wb") as out:
+            keys = [self.key(k) for k in key] if isinstance(key, list) else self.key(key)
+            envelope.encrypt_file(keys, inp, out, version, workers)
+
+    def do_decrypt(self, key, input, output, workers=None):
+        from tinyrsa import envelope
+        with open(input, "rb") as inp, open(output, "wb") as out:
+            envelope.decrypt_file(self.key(key, private=True), inp, out, workers)
+
+    def do_sign(self, key, input, tree_chunk=None, workers=None):
+        with open(input, "rb") as inp:
+            return RSA(self.key(key, private=True)).sign(inp, tree_chunk=tree_chunk, workers=workers)
+
+    def do_verify(self, key, input, signature, workers=None):
+        with open(input, "rb") as inp:
+            return RSA(self.key(key)).verify_signature(inp, signature, workers=workers)
+
+    def process(self, request):
+        op = request["op"]
+        if op not in ("encrypt", "decrypt", "sign", "verify"):
+            raise ValueError("Unknown operation: %s" % (op,))
+        return getattr(self, "do_" + op)(request["key"], **request.get("args", {}))
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = dict(ok=True, result=self.server.process(json.loads(line)))
+            except Exception as e:
+                response = dict(ok=False, error="%s: %s" % (e.__class__.__name__, e))
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+class ServerError(Exception):
+    pass
+
+class Client(object):
+
+    def __init__(self, path):
+        self.Sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.Sock.connect(path)
+        self.File = self.Sock.makefile("rwb")
+
+    def call(self, op, key, **args):
+        self.File.write((json.dumps(dict(op=op, key=key, args=args)) + "\n").encode("utf-8"))
+        self.File.flush()
+        response = json.loads(self.File.readline())
+        if not response["ok"]:
+            raise ServerError(response["error"])
+        return response["result"]
+
+    def close(self):
+        self.File.close()
+        self.Sock.close()
@@ -0,0 +1,99 @@
+#
+# Opt-in instrumentation: counters and timers for the hot paths.
+#
+# Disabled by default. When disabled, count() returns immediately and timer() returns
+# a shared no-op context manager, so instrumented code pays only for a function call.
+#
+#   from tinyrsa import stats
+#   stats.enable()
+#   ...
+#   stats.snapshot()   ->  {"counters": {name: value}, "timers": {name: {"count": n, "seconds": t}}}
+#
+# An exporter function can be set to receive snapshots, e.g. to forward them to a
+# metrics agent. It is called by export().
+#
+# Only the current process is counted. Work done in worker processes is not included.
+#
+
+import time, threading, importlib
+
+Enabled = False
+Counters = {}
+Timers = {}             # name -> [count, seconds]
+Exporter = None
+Lock = threading.Lock()
+
+def enable(exporter=None):
+    global Enabled, Exporter
+    Enabled = True
+    if exporter is not None:
+        Exporter = exporter
+
+def disable():
+    global Enabled
+    Enabled = False
+
+def reset():
+    with Lock:
+        Counters.clear()
+        Timers.clear()
+
+def count(name, n=1):
+    if not Enabled:
+        return
+    with Lock:
+        Counters[name] = Counters.get(name, 0) + n
+
+def add_time(name, seconds):
+    with Lock:
+        t = Timers.get(name)
+        if t is None:
+            t = Timers[name] = [0, 0.0]
+        t[0] += 1
+        t[1] += seconds
+
+class _Timer(object):
+
+    def __init__(self, name):
+        self.Name = name
+
+    def __enter__(self):
+        self.T0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *params):
+        add_time(self.Name, time.perf_counter() - self.T0)
+
+class _NoTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        pass
+
+_no_timer = _NoTimer()
+
+def timer(name):
+    # context manager measuring wall time of a phase
+    return _Timer(name) if Enabled else _no_timer
+
+def snapshot():
+    with Lock:
+        return dict(
+            counters = dict(Counters),
+            timers = {name: dict(count=c, seconds=t) for name, (c, t) in Timers.items()}
+        )
+
+def set_exporter(exporter):
+    global Exporter
+    Exporter = exporter
+
+def load_exporter(spec):
+    # "module:function" -> function
+    module, function = spec.split(":", 1)
+    return getattr(importlib.import_module(module), function)
+
+def export():
+    if Exporter is not None:
+        Exporter(snapshot())
@@ -1,113 +1,539 @@
-from tinyrsa import Key, KeyPair, RSA
-from tinyrsa.aes import AES
+#
+# Each command imports only the modules it needs, to keep the startup time short
+#
 
 import sys, getopt, os
 
 
 Usage = """
-tinyrsa   generate [-s <key size, bits>] -k <keypair file>
-          public -k <keypair file> [-o <public key file>]
-          encrypt -k <keypair or public key file> <input file> <output file>
-          decrypt -k <keypair or public key file> <input file> <output file>
-          sign -k <keypair file> <input file> (<signature file>|-)
-          verify -k <keypair or public key file> <input file> <signature file>
+tinyrsa   generate [-s <key size, bits>] [-j <workers>] -k <keypair file>
+          public <keypair> [-o <public key file>]
+          encrypt <key> [<key> ...] [-f <format version>] [-j <workers>] [-b <block size>] [-v] (<input file>|-) (<output file>|-)
+          encrypt -a <key> [-b <block size>] [-v] [--verify-prefix] <input file> <output file>
+          decrypt <keypair> [-j <workers>] [-b <block size>] [-v] [--range <start>:[<length>]] (<input file>|-) (<output file>|-)
+          sign <keypair> [-t <tree chunk size>] [-j <workers>] (<input file>|-) (<signature file>|-)
+          verify <key> [-j <workers>] (<input file>|-) <signature file>
+          verify-batch <key> [-j <workers>] [-q] <manifest file>
+          seal <key> [<key> ...] <signer> [-f <format version>] [-j <workers>] [-b <block size>] [-v] (<input file>|-) (<output file>|-) (<signature file>|-)
+          open <keypair> <signer> [-j <workers>] [-b <block size>] [-v] (<input file>|-) (<output file>|-) <signature file>
+          encrypt-tree <key> [<key> ...] [-j <workers>] [-b <chunk size>] [-a] [-q] <source directory> <output directory>
+          decrypt-tree <keypair> [-j <workers>] [-a] [-q] <source directory> <output directory>
+          pool fill [-s <key size, bits>] [-n <depth>] [-j <workers>] <spool directory>
+          pool take [-s <key size, bits>] -k <keypair file> <spool directory>
+          serve -k <key file> [-k <key file> ...] <socket path>
+          bench [-q] [-r <repeats>] [-o <output file>] [-b <baseline file>] [-t <tolerance>] [<benchmark> ...]
+          keyring import <keyring file> <key file> ...
+          keyring export <keyring file> <key id> [<key file>]
+          keyring delete <keyring file> <key id> ...
+          keyring list <keyring file>
+
+- stands for stdin or stdout
+<key>:      -k <keypair or public key file> | -K <keyring file>:<key id>
+<keypair>:  -k <keypair file> | -K <keyring file>:<key id>
+<signer>:   -s <keypair or public key file> | -S <keyring file>:<key id>
+          
+tinyrsa --server <socket path> (encrypt|decrypt|sign|verify) ...
+          performs the operation in the key server listening on the socket,
+          using keys loaded by the server
+
+tinyrsa --stats <command> ...
+          prints counters and timers collected while running the command to stderr,
+          and passes them to the function named by TINYRSA_STATS_EXPORTER=<module>:<function>, if set
 """
 
 def do_generate(argv):
-    opts, args = getopt.getopt(argv, "s:k:")
+    from tinyrsa.keys import KeyPair
+    opts, args = getopt.getopt(argv, "s:k:j:")
     opts = dict(opts)
     size = int(opts.get("-s", 512))
-    kp = KeyPair.generate(size)
-    fd = os.open(opts["-k"], os.O_WRONLY | os.O_CREAT, mode=0o700)
+    workers = int(opts.get("-j", 1))
+    kp = KeyPair.generate(size, workers=workers)
+    write_keypair(opts["-k"], kp)
+    
+def write_keypair(path, kp):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, mode=0o700)
     os.fdopen(fd, "w").write(kp.as_json())
     
+def load_key(opts, keypair=False):
+    # -k <key file> or -K <keyring file>:<key id>
+    from tinyrsa.keys import Key, KeyPair
+    if "-K" in opts:
+        from tinyrsa.keyring import Keyring
+        path, id = opts["-K"].rsplit(":", 1)
+        with Keyring(path, create=False) as keyring:
+            key = keyring.get(id)
+        if key is None:
+            print("key %s not found in %s" % (id, path), file=sys.stderr)
+            sys.exit(1)
+        if keypair and not isinstance(key, KeyPair):
+            print("key %s is not a key pair" % (id,), file=sys.stderr)
+            sys.exit(1)
+        return key
+    text = open(opts["-k"], "r").read()
+    return KeyPair.from_json(text) if keypair else Key.from_json(text)
+
 def do_public(argv):
-    opts, args = getopt.getopt(argv, "k:o:")
+    opts, args = getopt.getopt(argv, "k:K:o:")
     opts = dict(opts)
-    kp = KeyPair.from_json(open(opts["-k"], "r").read())
+    kp = load_key(opts, keypair=True)
     public = kp.public_key()
     out = open(opts["-o"], "w") if "-o" in opts else sys.stdout
     out.write(public.as_json())
     
+def open_input(path):
+    return sys.stdin.buffer if path == "-" else open(path, "rb")
+
+def open_output(path):
+    return sys.stdout.buffer if path == "-" else open(path, "wb")
+
+def print_aes_stats(aes):
+    stats = aes.stats()
+    throughput = stats.pop("throughput")
+    print(", ".join("%s: %s" % (name, value) for name, value in stats.items()),
+        "(%.1f MB/s)" % (throughput/1024/1024,) if throughput else "", file=sys.stderr)
+
 def do_encrypt(argv):
-    opts, args = getopt.getopt(argv, "k:")
+    from tinyrsa import envelope
+    opts, args = getopt.getopt(argv, "k:K:b:vf:j:a", ["verify-prefix"])
+    keys = [load_key({opt: value}) for opt, value in opts if opt in ("-k", "-K")]      # one or more recipients
     opts = dict(opts)
-    k = Key.from_json(open(opts["-k"], "r").read())
-    rsa = RSA(k)
-    aes = AES()
-    enc_key = aes.Key
-    enc_key = rsa.encrypt(enc_key)
+    block_size = int(opts["-b"]) if "-b" in opts else None
+    version = int(opts.get("-f", 4 if "-a" in opts else envelope.FORMAT_VERSION))
+    workers = int(opts["-j"]) if "-j" in opts else None
 
     inp, out = args
-    inp = open(inp, "rb")
-    out = open(out, "wb")
+    if "-a" in opts:
+        # append mode: encrypt only the data appended to the input since the previous run
+        if len(keys) != 1 or version != 4 or "-" in (inp, out):
+            print("-a requires one key, format version 4 and file names", file=sys.stderr)
+            sys.exit(2)
+        aes = envelope.append_file(keys[0], inp, out, block_size=block_size, verify_prefix="--verify-prefix" in opts)
+        if "-v" in opts:
+            print_aes_stats(aes)
+        return
+    inp = open_input(inp)
+    out = open_output(out)
 
-    out.write(bytes([len(enc_key)]))
-    out.write(enc_key)
-    
-    aes.encrypt_file(inp, out)
+    try:
+        aes = envelope.encrypt_file(keys, inp, out, version, workers, block_size)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    if "-v" in opts:
+        print_aes_stats(aes)
     
 def do_decrypt(argv):
-    opts, args = getopt.getopt(argv, "k:")
+    from tinyrsa import envelope
+    opts, args = getopt.getopt(argv, "k:K:b:vj:", ["range="])
     opts = dict(opts)
-    k = KeyPair.from_json(open(opts["-k"], "r").read())
-    rsa = RSA(k)
+    block_size = int(opts["-b"]) if "-b" in opts else None
+    workers = int(opts["-j"]) if "-j" in opts else None
+    k = load_key(opts, keypair=True)
 
     inp, out = args
-    inp = open(inp, "rb")
-    out = open(out, "wb")
+    if "--range" in opts:
+        if inp == "-":
+            print("--range requires an input file", file=sys.stderr)
+            sys.exit(2)
+        try:
+            start, length = opts["--range"].split(":", 1)
+            start, length = int(start), int(length) if length else None
+            if start < 0 or (length is not None and length < 0):
+                raise ValueError()
+        except ValueError:
+            print("--range requires <start>:[<length>], non-negative integers", file=sys.stderr)
+            sys.exit(2)
+        with envelope.open_encrypted(inp, k, workers) as f:
+            data = f.read(start, length)
+        open_output(out).write(data)
+        return
 
-    l = inp.read(1)[0]
-    enc_key = inp.read(l)
-    enc_key = rsa.decrypt(enc_key)
+    inp = open_input(inp)
+    out = open_output(out)
 
-    aes = AES(enc_key)
-    aes.decrypt_file(inp, out)
+    aes = envelope.decrypt_file(k, inp, out, workers, block_size)
+    if "-v" in opts:
+        print_aes_stats(aes)
     
 def do_sign(argv):
-    opts, args = getopt.getopt(argv, "k:")
+    from tinyrsa.rsalib import RSA, MIN_TREE_CHUNK
+    opts, args = getopt.getopt(argv, "k:K:t:j:")
     opts = dict(opts)
-    k = KeyPair.from_json(open(opts["-k"], "r").read())
+    k = load_key(opts, keypair=True)
     rsa = RSA(k)
+    tree_chunk = int(opts["-t"]) if "-t" in opts else None
+    if tree_chunk is not None and tree_chunk < MIN_TREE_CHUNK:
+        print("tree chunk size must be at least %d" % (MIN_TREE_CHUNK,), file=sys.stderr)
+        sys.exit(2)
+    workers = int(opts["-j"]) if "-j" in opts else None
     
     inp, sig = args
-    inp = open(inp, "rb")
-    signature = rsa.sign(inp)
+    inp = open_input(inp)
+    signature = rsa.sign(inp, tree_chunk=tree_chunk, workers=workers)
     out = sys.stdout if sig == "-" else open(sig, "w")
     out.write(signature+"\n")
     
 
 def do_verify(argv):
-    opts, args = getopt.getopt(argv, "k:")
+    from tinyrsa.rsalib import RSA
+    opts, args = getopt.getopt(argv, "k:K:j:")
     opts = dict(opts)
-    k = Key.from_json(open(opts["-k"], "r").read())
+    k = load_key(opts)
     rsa = RSA(k)
+    workers = int(opts["-j"]) if "-j" in opts else None
     
     inp, sig = args
-    inp = open(inp, "rb")
+    inp = open_input(inp)
     signature = open(sig, "r").read().strip()
-    ok = rsa.verify_signature(inp, signature)
+    ok = rsa.verify_signature(inp, signature, workers=workers)
     print ("verified" if ok else "forged")
     sys.exit(0 if ok else 1)
     
-def main():    
-    if len(sys.argv) < 2:
-        print(Usage)
+def do_verify_batch(argv):
+    from tinyrsa.rsalib import RSA
+    import pathlib
+    #
+    # manifest file: one "<input file> <signature file>" pair per line, the input file
+    # name may contain spaces. Relative paths are relative to the manifest file location
+    #
+    opts, args = getopt.getopt(argv, "k:K:j:q")
+    opts = dict(opts)
+    k = load_key(opts)
+    rsa = RSA(k)
+    workers = int(opts["-j"]) if "-j" in opts else None
+    quiet = "-q" in opts
+    
+    manifest = args[0]
+    base = os.path.dirname(manifest)
+    items = []
+    nerrors = 0
+    for line in open(manifest, "r"):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.rsplit(None, 1)
+        if len(fields) != 2:
+            print("%s: error: invalid manifest line: %s" % (manifest, line))
+            nerrors += 1
+            continue
+        inp, sig = os.path.join(base, fields[0]), os.path.join(base, fields[1])
+        try:
+            if not os.path.isfile(inp):
+                raise ValueError("input file not found")
+            signature = open(sig, "r").read().strip()
+        except (OSError, ValueError) as e:
+            print("%s: error: %s" % (inp, e))
+            nerrors += 1
+        else:
+            items.append((inp, signature))
+            
+    nverified = nforged = 0
+    results = rsa.verify_many(((pathlib.Path(inp), signature) for inp, signature in items), workers=workers)
+    for (inp, _), ok in zip(items, results):
+        if ok:
+            nverified += 1
+        else:
+            nforged += 1
+        if not ok or not quiet:
+            print("%s: %s" % (inp, "verified" if ok else "forged"))
+    print("verified: %d, forged: %d, errors: %d" % (nverified, nforged, nerrors), file=sys.stderr)
+    sys.exit(0 if nforged == 0 and nerrors == 0 else 1)
+    
+ProgressTime = 0.0
+
+def print_progress(done, total, nbytes, seconds):
+    global ProgressTime
+    if done < total and seconds - ProgressTime < 0.5:
+        return
+    ProgressTime = seconds
+    print("\r%d/%d files, %.1f MB, %.1f MB/s" % (done, total, nbytes/1024/1024, 
+        nbytes/1024/1024/seconds if seconds > 0 else 0.0), end="", file=sys.stderr)
+
+def load_signer(opts, keypair=False):
+    # -s <key file> or -S <keyring file>:<key id>
+    if "-S" in opts:
+        return load_key({"-K": opts["-S"]}, keypair)
+    return load_key({"-k": opts["-s"]}, keypair)
+
+def do_seal(argv):
+    from tinyrsa import envelope
+    opts, args = getopt.getopt(argv, "k:K:s:S:b:vf:j:")
+    keys = [load_key({opt: value}) for opt, value in opts if opt in ("-k", "-K")]
+    opts = dict(opts)
+    signer = load_signer(opts, keypair=True)
+    block_size = int(opts["-b"]) if "-b" in opts else None
+    version = int(opts.get("-f", envelope.FORMAT_VERSION))
+    workers = int(opts["-j"]) if "-j" in opts else None
+
+    inp, out, sig = args
+    inp = open_input(inp)
+    out = open_output(out)
+
+    try:
+        signature, aes = envelope.seal_file(keys, signer, inp, out, version, workers, block_size)
+    except ValueError as e:
+        print(e, file=sys.stderr)
         sys.exit(2)
+    out.flush()
+    sig = sys.stdout if sig == "-" else open(sig, "w")
+    sig.write(signature+"\n")
+    if "-v" in opts:
+        print_aes_stats(aes)
 
-    command, args = sys.argv[1], sys.argv[2:]
-    if command in ["generate","public","encrypt","decrypt","sign","verify"]:
-        {
-            "generate": do_generate,
-            "public":   do_public,
-            "encrypt":  do_encrypt,
-            "decrypt":  do_decrypt,
-            "sign":     do_sign,
-            "verify":   do_verify
-        }[command](args)
+def do_open(argv):
+    from tinyrsa import envelope
+    opts, args = getopt.getopt(argv, "k:K:s:S:b:vj:")
+    opts = dict(opts)
+    k = load_key(opts, keypair=True)
+    signer = load_signer(opts)
+    block_size = int(opts["-b"]) if "-b" in opts else None
+    workers = int(opts["-j"]) if "-j" in opts else None
+
+    inp, out_path, sig = args
+    signature = open(sig, "r").read().strip()
+    inp = open_input(inp)
+    out = open_output(out_path)
+
+    ok, aes = envelope.open_sealed_file(k, signer, inp, out, signature, workers, block_size)
+    out.close()
+    if not ok and out_path != "-":
+        os.unlink(out_path)         # do not leave forged data behind
+    if "-v" in opts:
+        print_aes_stats(aes)
+    print("verified" if ok else "forged", file=sys.stderr if out_path == "-" else sys.stdout)
+    sys.exit(0 if ok else 1)
+
+def do_tree(command, argv):
+    #
+    # -a: process all files, not only the ones changed since the previous run
+    # -q: do not print progress
+    #
+    from tinyrsa import bulk
+    opts, args = getopt.getopt(argv, "k:K:j:b:aq")
+    keys = [load_key({opt: value}, keypair=command == "decrypt-tree") for opt, value in opts if opt in ("-k", "-K")]
+    opts = dict(opts)
+    workers = int(opts["-j"]) if "-j" in opts else None
+    incremental = "-a" not in opts
+    progress = None if "-q" in opts else print_progress
+    src, dst = args
+    if command == "encrypt-tree":
+        chunk_size = int(opts["-b"]) if "-b" in opts else None
+        result = bulk.encrypt_tree(keys, src, dst, workers, incremental, progress, chunk_size)
+    else:
+        result = bulk.decrypt_tree(keys[0], src, dst, workers, incremental, progress)
+    if progress is not None and result["files"] + len(result["errors"]):
+        print(file=sys.stderr)
+    for rel, error in result["errors"]:
+        print("%s: error: %s" % (rel, error), file=sys.stderr)
+    print("processed: %d, skipped: %d, errors: %d, %.1f MB in %.1f s" % (result["files"], result["skipped"], 
+        len(result["errors"]), result["bytes"]/1024/1024, result["seconds"]), file=sys.stderr)
+    sys.exit(1 if result["errors"] else 0)
+
+def do_encrypt_tree(argv):
+    do_tree("encrypt-tree", argv)
+
+def do_decrypt_tree(argv):
+    do_tree("decrypt-tree", argv)
+
+def do_pool(argv):
+    from tinyrsa.keypool import KeyPool
+    if not argv or argv[0] not in ("fill", "take"):
+        print(Usage)
+        sys.exit(2)
+    command, argv = argv[0], argv[1:]
+    opts, args = getopt.getopt(argv, "s:n:j:k:")
+    opts = dict(opts)
+    size = int(opts.get("-s", 512))
+    spool = args[0]
+    if command == "fill":
+        pool = KeyPool(size, depth=int(opts.get("-n", 32)), spool=spool, 
+                workers=int(opts.get("-j", 1)), background=False)
+        n = pool.fill()
+        print("generated %d keys, %d keys in the pool" % (n, pool.count()))
+    else:
+        pool = KeyPool(size, spool=spool, background=False)
+        write_keypair(opts["-k"], pool.take())
+    
+def do_serve(argv):
+    from tinyrsa.server import KeyServer
+    import signal
+    opts, args = getopt.getopt(argv, "k:")
+    key_files = [value for opt, value in opts if opt == "-k"]
+    try:
+        server = KeyServer(args[0], key_files)
+    except FileExistsError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, lambda *params: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(args[0])
+        
+def do_client(sock, command, argv):
+    from tinyrsa.server import Client, ServerError
+    from tinyrsa.formats import FORMAT_VERSION
+    opts, args = getopt.getopt(argv, "k:K:f:j:t:")
+    # key file paths, or key ids for -K <keyring file>:<key id>; the keys must be loaded by the server
+    keys = [os.path.abspath(value) if opt == "-k" else value.rsplit(":", 1)[-1] 
+            for opt, value in opts if opt in ("-k", "-K")]
+    opts = dict(opts)
+    if not keys:
+        print(Usage)
+        sys.exit(2)
+    key = keys[-1]
+    workers = int(opts["-j"]) if "-j" in opts else None
+    client = Client(sock)
+    try:
+        if command == "encrypt":
+            inp, out = args
+            version = int(opts.get("-f", FORMAT_VERSION))
+            client.call("encrypt", keys if len(keys) > 1 else key, input=os.path.abspath(inp), output=os.path.abspath(out), 
+                    version=version, workers=workers)
+        elif command == "decrypt":
+            inp, out = args
+            client.call("decrypt", key, input=os.path.abspath(inp), output=os.path.abspath(out), workers=workers)
+        elif command == "sign":
+            inp, sig = args
+            tree_chunk = int(opts["-t"]) if "-t" in opts else None
+            signature = client.call("sign", key, input=os.path.abspath(inp), tree_chunk=tree_chunk, workers=workers)
+            out = sys.stdout if sig == "-" else open(sig, "w")
+            out.write(signature+"\n")
+        elif command == "verify":
+            inp, sig = args
+            signature = open(sig, "r").read().strip()
+            ok = client.call("verify", key, input=os.path.abspath(inp), signature=signature, workers=workers)
+            print ("verified" if ok else "forged")
+            sys.exit(0 if ok else 1)
+        else:
+            print(Usage)
+            sys.exit(2)
+    except ServerError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        client.close()
+    
+def do_bench(argv):
+    from tinyrsa import bench
+    import json
+    opts, args = getopt.getopt(argv, "qr:o:b:t:")
+    opts = dict(opts)
+    repeats = int(opts["-r"]) if "-r" in opts else None
+    unknown = [name for name in args if name not in bench.Benchmark.BENCHMARKS]
+    if unknown:
+        print("unknown benchmark: %s, available: %s" % (" ".join(unknown), " ".join(bench.Benchmark.BENCHMARKS)), file=sys.stderr)
+        sys.exit(2)
+    report = bench.run(quick="-q" in opts, repeats=repeats, benchmarks=args or None, log=sys.stderr)
+    text = json.dumps(report, indent=2) + "\n"
+    if "-o" in opts:
+        open(opts["-o"], "w").write(text)
     else:
+        sys.stdout.write(text)
+    if "-b" in opts:
+        baseline = json.load(open(opts["-b"], "r"))
+        tolerance = float(opts.get("-t", 0.1))
+        regressions = bench.compare(report, baseline, tolerance)
+        for name, base, current in regressions:
+            print("regression: %s: %.6f -> %.6f s (%+.1f%%)" % (name, base, current, (current/base-1)*100), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+    
+def do_keyring(argv):
+    from tinyrsa.keyring import Keyring
+    if len(argv) < 2 or argv[0] not in ("import", "export", "delete", "list"):
         print(Usage)
         sys.exit(2)
+    command, path, args = argv[0], argv[1], argv[2:]
+    with Keyring(path, create=command == "import") as keyring:
+        if command == "import":
+            nerrors = 0
+            for key_file in args:
+                try:
+                    key = keyring.import_json(open(key_file, "r").read())
+                except ValueError as e:
+                    print("%s: not imported: %s" % (key_file, e), file=sys.stderr)
+                    nerrors += 1
+                else:
+                    print("%s: imported %s" % (key_file, key.ID))
+            if nerrors:
+                sys.exit(1)
+        elif command == "export":
+            key = keyring.get(args[0])
+            if key is None:
+                print("%s: not found" % (args[0],), file=sys.stderr)
+                sys.exit(1)
+            if len(args) > 1:
+                write_keypair(args[1], key)
+            else:
+                sys.stdout.write(key.as_json())
+        elif command == "delete":
+            for id in args:
+                if not keyring.delete(id):
+                    print("%s: not found" % (id,), file=sys.stderr)
+        else:
+            for id in keyring.ids():
+                print(id)
+    
+def print_stats():
+    from tinyrsa import stats
+    import json
+    stats.export()
+    print(json.dumps(stats.snapshot(), indent=2), file=sys.stderr)
+
+def main():    
+    argv = sys.argv[1:]
+    server = None
+    show_stats = False
+    while argv and argv[0].startswith("--"):
+        if argv[0] == "--stats":
+            show_stats = True
+            argv = argv[1:]
+        elif argv[0] == "--server" and len(argv) > 1:
+            server = argv[1]
+            argv = argv[2:]
+        else:
+            break
+
+    if not argv:
+        print(Usage)
+        sys.exit(2)
+
+    if show_stats:
+        from tinyrsa import stats
+        exporter = os.environ.get("TINYRSA_STATS_EXPORTER")
+        stats.enable(stats.load_exporter(exporter) if exporter else None)
+
+    command, args = argv[0], argv[1:]
+    try:
+        if server is not None:
+            do_client(server, command, args)
+        elif command in ["generate","public","encrypt","decrypt","sign","verify","verify-batch","seal","open","encrypt-tree","decrypt-tree","pool","serve","bench","keyring"]:
+            {
+                "generate": do_generate,
+                "public":   do_public,
+                "encrypt":  do_encrypt,
+                "decrypt":  do_decrypt,
+                "sign":     do_sign,
+                "verify":   do_verify,
+                "verify-batch":   do_verify_batch,
+                "seal":     do_seal,
+                "open":     do_open,
+                "encrypt-tree":   do_encrypt_tree,
+                "decrypt-tree":   do_decrypt_tree,
+                "pool":     do_pool,
+                "serve":    do_serve,
+                "bench":    do_bench,
+                "keyring":  do_keyring
+            }[command](args)
+        else:
+            print(Usage)
+            sys.exit(2)
+    finally:
+        if show_stats:
+            print_stats()
     
 if __name__ == "__main__":
     main()